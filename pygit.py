@@ -1,11 +1,29 @@
 import argparse
+import array
+import bisect
 import collections
+import concurrent.futures
 import configparser
 import hashlib
+import math
+import mmap
 import os
+import re
+import shutil
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
 import zlib
 
+try:
+    import fcntl
+except ImportError:
+    # Windows上没有fcntl，clone时不能用reflink
+    fcntl = None
+
 argparser = argparse.ArgumentParser(description="The stupid content tracker")
 argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
 argsubparsers.required = True 
@@ -20,20 +38,28 @@ def main(argv=sys.argv[1:]):
         cmd_cat_file(args)
     elif args.command == "checkout":
         cmd_checkout(args)
+    elif args.command == "clone":
+        cmd_clone(args)
     elif args.command == "commit":
         cmd_commit(args)
+    elif args.command == "gc":
+        cmd_gc(args)
     elif args.command == "hash-object":
         cmd_hash_object(args)
     elif args.command == "init":
         cmd_init(args)
     elif args.command == "log":
         cmd_log(args)
-    elif args.command == "is-tree":
-        cmd_is_tree(args)
+    elif args.command == "ls-tree":
+        cmd_ls_tree(args)
     elif args.command == "merge":
         cmd_merge(args)
+    elif args.command == "multi-pack-index":
+        cmd_multi_pack_index(args)
     elif args.command == "rebase":
         cmd_rebase(args)
+    elif args.command == "repack":
+        cmd_repack(args)
     elif args.command == "rev-parse":
         cmd_rev_parse(args)
     elif args.command == "rm":
@@ -49,8 +75,16 @@ class GitRepository(object):
     worktree = None # 工作树
     gitdir = None # .git 目录
     conf = None # 配置文件（里面就是一个INI）
-
-    def __init__(self, path, force=False):
+    object_dirs = None # 对象目录: 自己的objects和alternates中借用的目录（第一次使用时加载）
+    loose_index = None # 每个对象目录的松散对象索引 GitLooseIndex（和object_dirs一一对应）
+    packs = None # 所有对象目录中不在multi-pack-index里的packfile列表（第一次使用时加载）
+    midxs = None # 所有对象目录中的multi-pack-index（和packs一起加载）
+    pack_windows = None # 映射到内存的idx和pack文件 GitPackWindows
+    cache = None # 对象缓存 GitObjectCache，关闭时为None
+    delta_base_cache = None # 重建出来的delta基对象的缓存，按(pack, 偏移)索引
+    object_ids = None # 所有对象id的有序列表，用来查找短hash（第一次使用时建立）
+
+    def __init__(self, path, force=False, cache=True):
         self.worktree = path
         self.gitdir = os.path.join(path, ".git")
 
@@ -66,11 +100,26 @@ class GitRepository(object):
         elif not force:
             raise Exception("配置文件丢失")
 
+        self.pack_windows = GitPackWindows(PACK_OPEN_LIMIT,
+                                           config_size(self.conf.get("core", "packedgitlimit", fallback="8g")))
+
         if not force:
             vers = int(self.conf.get("core", "repositoryformatversion")) # 版本号
             if vers != 0:
                 raise Exception("不支持的仓库版本号{}".format(vers))
 
+        # 对象缓存，大小由core.objectCacheLimit决定（0表示关闭）
+        # 只读一两个对象的命令可以用cache=False关掉
+        if cache:
+            limit = config_size(self.conf.get("core", "objectcachelimit", fallback="32m"))
+            if limit:
+                self.cache = GitObjectCache(limit)
+
+            # 和git一样由core.deltaBaseCacheLimit决定（默认96m）
+            limit = config_size(self.conf.get("core", "deltabasecachelimit", fallback="96m"))
+            if limit:
+                self.delta_base_cache = GitObjectCache(limit)
+
     
 # 处理路径（缺少目录结构时需创建）
 
@@ -100,7 +149,7 @@ def repo_dir(repo, *path, mkdir=False):
             raise Exception("{}路径不是一个目录".format(path))
         
     if mkdir:
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True) # 多个线程可能同时创建同一个目录
         return path
     else:
         return None
@@ -150,6 +199,14 @@ def repo_default_config():
 
     return ret
 
+def config_size(value):
+    """解析配置中的大小，支持k/m/g后缀，例如 32m"""
+    value = value.strip().lower()
+    units = { "k": 1024, "m": 1024**2, "g": 1024**3 }
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
 # 命令参数处理器
 argsp = argsubparsers.add_parser("init", help = "初始化一个新的空仓库")
 
@@ -166,15 +223,15 @@ def cmd_init(args):
     repo_create(args.path)
 
 # 由于几乎所有的git命令（除了git init）都需要在git 仓库下进行。
-def repo_find(path = ".", required = True):
+def repo_find(path = ".", required = True, cache = True):
     # 返回一个规范的路径 （例如 会去除中间的空格 或者../../这样的形式）
     path = os.path.realpath(path)
 
     if os.path.isdir(os.path.join(path, ".git")):
-        return GitRepository(path)
+        return GitRepository(path, cache=cache)
     
     # 如果当前目录没有.git文件夹 向上查询
-    parent = os.path.realpath(os.path.join,"..")
+    parent = os.path.realpath(os.path.join(path, ".."))
 
     if parent == path:
         # 递归调用
@@ -185,7 +242,7 @@ def repo_find(path = ".", required = True):
         else:
             return None
 
-    return repo_find(parent, required)
+    return repo_find(parent, required, cache)
 
 # 底层的git hash-object  与 git cat file 实现 
 # hash-object 用来将已经存在的文件转换成一个 git 对象，cat-file 将已经存在的的Git对象打印到标准输出
@@ -199,7 +256,7 @@ def repo_find(path = ".", required = True):
 
 # 通用对象类-> 单例设计模式
 class GitObject(object):
-    repo = None
+    __slots__ = ("repo",) # 子类不定义__slots__时仍然有__dict__
 
     def __init__(self, repo, data=None):
         self.repo = repo
@@ -225,35 +282,924 @@ class GitObject(object):
 def object_read(repo, sha):
     """从Git仓库中rep中读取对象，返回GitObject（确定类型取决于这个对象）"""
 
-    # 路径获得
-    path = repo_file(repo, "objects", sha[:2],sha[2:])
+    fmt, data = object_read_raw(repo, sha)
+
+    if fmt == b'commit':
+        c = GitCommit
+    elif fmt == b'blob':
+        c = GitBlob
+    elif fmt == b'tag':
+        c = GitTag
+    elif fmt == b'tree':
+        c = GitTree
+    else:
+        raise Exception("{}是未知的类型{}".format(fmt.decode("ascii"), sha))
+
+    # 调用构造函数并返回对象
+    return c(repo, data)
+
+def object_read_raw(repo, sha):
+    """读取对象的类型(flag)和内容，优先从repo的对象缓存中取"""
+    if repo.cache is not None:
+        ret = repo.cache.get(sha)
+        if ret is not None:
+            return ret
+
+    ret = object_load(repo, sha)
+
+    if repo.cache is not None:
+        repo.cache.put(sha, *ret)
+    return ret
 
+def object_load(repo, sha):
+    """从对象库中读取对象的类型和内容，先找松散对象，找不到再去packfile里找"""
+    f, pack, offset = object_open(repo, sha)
+    if pack:
+        return pack_read(repo, pack, offset)
+
+    with f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            # 大的松散对象直接从映射的内存解压，不用先复制成bytes
+            view = mmap_open(f)
+            try:
+                raw = zlib.decompress(view)
+            finally:
+                mmap_close(view)
+        else:
+            raw = zlib.decompress(f.read())
+
+    # 读取对象类型
+    x = raw.find(b' ')
+    fmt = raw[:x] # 读取对象类型 flag(commit or tag等)
+
+    # 读取并校验对象大小
+    y = raw.find(b'\x00' ,x)   # '\x00' 代表着null 字节,代表着终止符.
+    size = int(raw[x:y].decode("ascii")) # 读取大小 从空格开始到终止符结束就是文件的大小[本来应该是空格处索引+1,但是切片正好是左闭又开.结果是一样的.]
+    if size != len(raw)-y-1:
+        raise Exception("文件校验失败")
+
+    return fmt, raw[y+1:]
+
+def object_open(repo, sha):
+    """找到对象存放的位置: 松散对象返回 (打开的文件, None, None)，pack中的对象返回 (None, GitPack, 偏移)，
+    对象不存在时抛出异常。松散对象打开以后再被别的进程删除也不影响读取"""
+    while True:
+        path = object_path(repo, sha)
+        if path is None:
+            pack, offset = pack_find(repo, sha)
+            if pack:
+                return None, pack, offset
+
+            # 可能是别的进程刚写入的松散对象，索引还没有发现
+            path = object_path(repo, sha, fresh=True)
+            if path is None:
+                raise Exception("对象{}不存在".format(sha))
+
+        try:
+            return open(path, "rb"), None, None
+        except FileNotFoundError:
+            # 被别的进程打包删除了，去pack中找
+            object_vanished(repo, sha, path)
+
+# 内存映射
+# idx在第一次查找、pack在第一次读取对象时映射到内存，查找和解压都直接在映射上进行:
+# memoryview的切片不会复制数据，zlib可以直接从映射的页面解压，多个线程读同一个pack时也只占一份内存（page cache）。
+# 每个映射都占着一个文件描述符，所以仓库的GitPackWindows只保留最近用过的PACK_OPEN_LIMIT个映射，
+# 映射的总大小也不超过core.packedGitLimit（和git一样默认8g），超出时关掉最久没用的，下次用到再重新映射。
+# 超过MMAP_THRESHOLD的松散对象也用映射读取，小对象直接read更快。
+
+MMAP_THRESHOLD = 1 << 20 # 大于1M的松散对象用mmap读取
+PACK_OPEN_LIMIT = 64 # 同时映射的idx和pack文件最多有几个
+
+def mmap_file(path):
+    """把文件只读映射到内存，返回memoryview"""
     with open(path, "rb") as f:
-        raw = zlib.deccompress(f.read())
+        return mmap_open(f)
+
+def mmap_open(f):
+    """把已经打开的文件只读映射到内存，返回memoryview（映射不依赖f，之后可以关闭f）"""
+    return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def mmap_close(view):
+    m = view.obj
+    view.release()
+    try:
+        m.close()
+    except BufferError:
+        # 还有别的切片在使用这个映射，等它们被回收时再释放
+        pass
+
+class GitPackWindows(object):
+    """映射到内存的idx和pack文件，按个数和总字节数限制的LRU"""
+
+    def __init__(self, limit, size_limit):
+        self.limit = limit # 最多同时映射的文件个数
+        self.size_limit = size_limit # 映射的总字节数上限
+        self.size = 0
+        self.entries = collections.OrderedDict() # 路径 -> memoryview，最近使用的在最后
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """返回path的映射，没有映射的话现在映射"""
+        with self.lock:
+            view = self.entries.get(path)
+            if view is not None:
+                self.entries.move_to_end(path)
+                return view
+
+            view = mmap_file(path)
+            self.entries[path] = view
+            self.size += len(view)
+            # 刚映射的这个总是留着
+            while len(self.entries) > 1 and (len(self.entries) > self.limit or self.size > self.size_limit):
+                # 别的线程可能还在用淘汰的映射，不能release，最后一个引用消失时mmap自己会关闭
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+            return view
+
+    def close(self, path):
+        """立即关闭path的映射（删除文件之前）"""
+        with self.lock:
+            view = self.entries.pop(path, None)
+            if view is not None:
+                self.size -= len(view)
+                mmap_close(view)
+
+# 对象缓存
+# 每次object_read都要重新打开、解压、解析对象，而ls-tree、object_find（跟随tag）、log这些命令会反复读取同样的commit和tree。
+# GitRepository上挂一个按sha索引的LRU缓存，缓存的是解压后的 (类型, 内容)，总字节数超过上限时淘汰最久没用的。
+# 缓存的是不可变的bytes，每次还是会构造新的GitObject，调用者修改对象不会影响缓存。
+
+class GitObjectCache(object):
+    """按字节数限制大小的LRU对象缓存
+    键一般是sha，delta基对象缓存用的是 (pack路径, 偏移)"""
+
+    def __init__(self, limit):
+        self.limit = limit # 最多缓存的字节数
+        self.size = 0 # 当前缓存的字节数
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict() # sha -> (类型, 内容)，最近使用的在最后
+
+    def get(self, sha):
+        ret = self.entries.get(sha)
+        if ret is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(sha)
+        return ret
+
+    def put(self, sha, fmt, data):
+        if len(data) > self.limit:
+            # 比整个缓存还大的对象不缓存
+            return
+        if sha in self.entries:
+            self.entries.move_to_end(sha)
+            return
+
+        self.entries[sha] = (fmt, data)
+        self.size += len(data)
+        while self.size > self.limit:
+            old_sha, (old_fmt, old_data) = self.entries.popitem(last=False)
+            self.size -= len(old_data)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+# 流式读取
+# object_read 会把整个对象解压到内存里，再切片去掉头部，一个2G的blob要占4G内存。
+# object_stream 只解压出头部 "类型 大小\x00"，之后的内容按块返回，内存占用和对象大小无关。
+
+STREAM_CHUNK = 65536 # 每次读取/解压的块大小
+
+def inflate_stream(f):
+    """从文件当前位置解压一段zlib数据，每次最多返回STREAM_CHUNK个字节"""
+    d = zlib.decompressobj()
+    while not d.eof:
+        buf = d.unconsumed_tail
+        if not buf:
+            buf = f.read(STREAM_CHUNK)
+            if not buf:
+                raise Exception("zlib数据被截断了")
+        chunk = d.decompress(buf, STREAM_CHUNK)
+        if chunk:
+            yield chunk
+
+def inflate_view(view, pos):
+    """和inflate_stream一样，只是直接从映射到内存的文件（memoryview）中pos处解压"""
+    d = zlib.decompressobj()
+    while not d.eof:
+        buf = d.unconsumed_tail
+        if not buf:
+            buf = view[pos:pos+STREAM_CHUNK]
+            pos += len(buf)
+            if not buf:
+                raise Exception("zlib数据被截断了")
+        chunk = d.decompress(buf, STREAM_CHUNK)
+        if chunk:
+            yield chunk
+
+def stream_check(chunks, size):
+    """原样返回chunks，结束时检查总长度是否等于size"""
+    n = 0
+    for chunk in chunks:
+        n += len(chunk)
+        yield chunk
+    if n != size:
+        raise Exception("文件校验失败")
+
+def object_stream(repo, sha):
+    """流式读取对象，返回 (类型, 大小, 内容的迭代器)"""
+    if repo.cache is not None:
+        found = repo.cache.get(sha)
+        if found is not None:
+            fmt, data = found
+            return fmt, len(data), iter([data])
+
+    f, pack, offset = object_open(repo, sha)
+    if pack:
+        return pack_stream(repo, pack, offset)
+
+    def inflate():
+        with f:
+            if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+                view = mmap_open(f)
+                try:
+                    yield from inflate_view(view, 0)
+                finally:
+                    mmap_close(view)
+            else:
+                yield from inflate_stream(f)
+
+    chunks = inflate()
+    head = b''
+    while b'\x00' not in head:
+        head += next(chunks)
+
+    y = head.find(b'\x00')
+    x = head.find(b' ')
+    fmt = head[:x]
+    size = int(head[x:y].decode("ascii"))
+
+    def body():
+        yield head[y+1:]
+        yield from chunks
+
+    return fmt, size, stream_check(body(), size)
+
+
+# 只读取对象头
+# 很多地方只需要对象的类型（ls-tree显示每一项的类型，object_find比较类型），没必要解压整个对象。
+# 松散对象只解压开头几十个字节就能得到 "类型 大小\x00"；pack中的对象头部本身就有类型和大小，
+# delta对象的大小在delta数据的开头，类型要沿着基对象找下去（只读头部，不解压）。
+
+def object_header(repo, sha):
+    """返回对象的 (类型, 大小)，不解压整个对象"""
+    if repo.cache is not None:
+        found = repo.cache.get(sha)
+        if found is not None:
+            fmt, data = found
+            return fmt, len(data)
+
+    f, pack, offset = object_open(repo, sha)
+    if pack:
+        return pack_header(repo, pack, offset)
+
+    with f:
+        d = zlib.decompressobj()
+        head = b''
+        while b'\x00' not in head:
+            buf = d.unconsumed_tail or f.read(64)
+            if not buf:
+                raise Exception("文件校验失败")
+            head += d.decompress(buf, 64)
+
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    return head[:x], int(head[x:y].decode("ascii"))
+
+
+# packfile
+# 从上游git导入的仓库，对象大多不是松散对象，而是打包在 .git/objects/pack/pack-xxx.pack 中，
+# 同名的 .idx 文件是它的索引。这里只支持version 2 的idx:
+# [magic \377tOc] [version 2] [fanout 256*4字节] [N个sha 20字节] [N个crc32] [N个4字节偏移] [8字节大偏移] [pack校验和] [idx校验和]
+# fanout[i] 表示第一个字节 <= i 的对象个数，所以第一个字节为b的对象，sha落在 fanout[b-1]..fanout[b] 之间，在这段里二分查找即可。
+#
+# pack中的每个对象: [类型和大小(变长编码)] [OFS_DELTA的负偏移 或者 REF_DELTA的基对象sha] [zlib压缩的数据]
+
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+pack_type_fmt = {
+    PACK_OBJ_COMMIT: b'commit',
+    PACK_OBJ_TREE: b'tree',
+    PACK_OBJ_BLOB: b'blob',
+    PACK_OBJ_TAG: b'tag',
+}
+
+class GitPack(object):
+    """一个packfile 以及它的 .idx 索引
+    创建时不打开任何文件，idx在第一次查找时、pack在第一次读取对象时才通过windows映射到内存"""
+
+    idxpath = None
+    packpath = None
+    windows = None # 仓库的GitPackWindows
+    fanout = None # 第一次读取idx时解析
+    local = True # 是否在仓库自己的objects目录中（不是alternates借来的）
+
+    def __init__(self, idxpath, windows):
+        self.idxpath = idxpath
+        self.packpath = idxpath[:-len(".idx")] + ".pack"
+        self.windows = windows
+
+    @property
+    def idx(self):
+        idx = self.windows.get(self.idxpath)
+        if self.fanout is None:
+            self.parse(idx)
+        return idx
+
+    @property
+    def data(self):
+        return self.windows.get(self.packpath)
+
+    @property
+    def count(self):
+        """对象个数"""
+        if self.fanout is None:
+            self.idx
+        return self.fanout[255]
+
+    def parse(self, idx):
+        """检查idx的头部，读出fanout和各个表的起始位置"""
+        if idx[:4] != b'\377tOc':
+            raise Exception("{}不是version 2的idx文件".format(self.idxpath))
+        vers = struct.unpack_from(">I", idx, 4)[0]
+        if vers != 2:
+            raise Exception("不支持的idx版本号{}".format(vers))
+
+        fanout = struct.unpack_from(">256I", idx, 8)
+        count = fanout[255]
+
+        # 各个表的起始位置
+        self.sha_start = 8 + 256*4
+        self.crc_start = self.sha_start + 20*count
+        self.ofs_start = self.crc_start + 4*count
+        self.large_ofs_start = self.ofs_start + 4*count
+        # 最后设置fanout，别的线程看到它时上面的位置都已经算好了
+        self.fanout = fanout
+
+    def sha(self, i):
+        """第i个对象的sha(20字节)"""
+        idx = self.idx
+        start = self.sha_start + 20*i
+        return idx[start:start+20]
+
+    def offset(self, i):
+        """第i个对象在pack中的偏移"""
+        ofs = struct.unpack_from(">I", self.idx, self.ofs_start + 4*i)[0]
+        if ofs & 0x80000000:
+            # 最高位为1时，剩下的是大偏移表的下标
+            ofs = struct.unpack_from(">Q", self.idx, self.large_ofs_start + 8*(ofs & 0x7fffffff))[0]
+        return ofs
+
+    def shas(self):
+        """所有对象的sha（16进制字符串），和idx中一样是排好序的"""
+        h = self.idx[self.sha_start:self.crc_start].hex()
+        return [ h[i:i+40] for i in range(0, len(h), 40) ]
+
+    def find(self, sha):
+        """在fanout限定的范围内二分查找，返回对象在pack中的偏移，找不到返回None"""
+        # 先读取idx，sha_table_bisect要用到fanout
+        self.idx
+        i, end = sha_table_bisect(self, int(sha, 16))
+        if i < end and self.sha(i) == bytes.fromhex(sha):
+            return self.offset(i)
+        return None
 
-        # 读取对象类型
-        x = raw.find(b' ') 
-        fmt = raw[:x] # 读取对象类型 flag(commit or tag等)
+    def close(self):
+        self.windows.close(self.idxpath)
+        self.windows.close(self.packpath)
+
+def pack_list(repo):
+    """返回仓库（包括alternates）中不在multi-pack-index里的packfile（结果保存在repo.packs中）
+    multi-pack-index包含的pack由它自己在第一次查到其中的对象时才打开"""
+    if repo.packs is None:
+        packs = list()
+        midxs = list()
+
+        for objdir in object_dirs(repo):
+            path = os.path.join(objdir, "pack")
+            if not os.path.isdir(path):
+                continue
+
+            local = objdir == object_dirs(repo)[0]
+            names = set(f for f in os.listdir(path)
+                        if f.endswith(".idx") and os.path.isfile(os.path.join(path, f[:-4] + ".pack")))
+
+            midx = os.path.join(path, "multi-pack-index")
+            if os.path.isfile(midx):
+                midx = GitMultiPackIndex(midx, repo.pack_windows)
+                # multi-pack-index中的pack已经不存在了（被repack删掉了），就当它不存在
+                if all(name in names for name in midx.names):
+                    midx.local = local
+                    midxs.append(midx)
+                    names -= set(midx.names)
+
+            for f in sorted(names):
+                pack = GitPack(os.path.join(path, f), repo.pack_windows)
+                pack.local = local
+                packs.append(pack)
+
+        repo.midxs = midxs
+        repo.packs = packs
+    return repo.packs
+
+def pack_all(repo):
+    """返回所有的packfile，包括multi-pack-index中的（会为它们都创建GitPack）"""
+    packs = pack_list(repo)
+    return [ pack for midx in repo.midxs for pack in midx.all_packs() ] + packs
+
+def pack_midx(repo):
+    """返回仓库自己的multi-pack-index，没有的话返回None"""
+    pack_list(repo)
+    for midx in repo.midxs:
+        if midx.local:
+            return midx
+    return None
+
+def pack_find(repo, sha):
+    """在所有pack中查找对象，返回 (GitPack, 偏移)，找不到返回 (None, None)
+    先查multi-pack-index（一次二分查找覆盖它包含的所有pack），再查不在其中的pack"""
+    packs = pack_list(repo)
+
+    for midx in repo.midxs:
+        found = midx.find(sha)
+        if found:
+            return found
+
+    for pack in packs:
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack, offset
+
+    return None, None
+
+# alternates
+# objects/info/alternates 每行是另一个对象目录的路径（绝对路径，或者相对于这个objects目录），
+# 这个仓库可以直接读取那里的对象，很多仓库就能共用一个本地的对象库，不用每个都复制一份。
+# 被借用的目录自己也可以有alternates，和git一样最多递归5层。
+# 写入总是写到仓库自己的objects目录中。
+
+ALTERNATES_DEPTH = 5
+
+def object_dirs(repo):
+    """返回所有对象目录，第一个是仓库自己的objects目录"""
+    if repo.object_dirs is None:
+        dirs = list()
+        queue = [ (repo_path(repo, "objects"), 0) ]
+        while queue:
+            path, depth = queue.pop(0)
+            path = os.path.realpath(path)
+            if path in dirs:
+                continue
+            dirs.append(path)
+
+            alternates = os.path.join(path, "info", "alternates")
+            if depth >= ALTERNATES_DEPTH or not os.path.isfile(alternates):
+                continue
+            with open(alternates, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        queue.append((os.path.join(path, line), depth+1))
+
+        repo.object_dirs = dirs
+    return repo.object_dirs
+
+def object_path(repo, sha, fresh=False):
+    """松散对象的路径（在自己或者借用的对象目录中），不存在返回None
+    fresh为True时没找到会立即检查目录有没有变化，不等LOOSE_INDEX_TTL"""
+    for index in loose_index(repo):
+        if index.contains(sha, fresh):
+            return os.path.join(index.path, sha[:2], sha[2:])
+    return None
+
+def object_vanished(repo, sha, path):
+    """索引中有但是已经被删除的松散对象（别的进程repack或者gc了）: 从索引中去掉，重新加载pack列表"""
+    objdir = os.path.dirname(os.path.dirname(path))
+    for index in loose_index(repo):
+        if index.path == objdir:
+            index.discard(sha)
+    repo.packs = None
+
+def object_borrowed(repo, sha):
+    """对象是否可以从alternates中读到"""
+    for index in loose_index(repo)[1:]:
+        if index.contains(sha):
+            return True
+    for pack in pack_list(repo):
+        if not pack.local and pack.find(sha) is not None:
+            return True
+    for midx in repo.midxs:
+        if not midx.local and midx.find(sha):
+            return True
+    return False
+
+# 松散对象索引
+# 判断松散对象是否存在要stat一次objects/xx/yyyy（有alternates时每个对象目录一次），列出所有对象要遍历256个子目录。
+# GitLooseIndex在内存里记住一个对象目录中的松散对象: 某个xx子目录第一次用到时listdir一次，之后的查找不需要系统调用。
+# 别的进程也可能写入对象，所以没找到时会检查子目录的mtime，变了就重新listdir；
+# 为了不在每次没找到时都stat，同一个子目录LOOSE_INDEX_TTL秒内只检查一次。自己写入和删除的对象直接更新索引。
+
+LOOSE_INDEX_TTL = 1.0 # 秒
+
+class GitLooseIndex(object):
+    """一个对象目录中的松散对象"""
+
+    def __init__(self, path):
+        self.path = path
+        self.dirs = dict() # "xx" -> [子目录的mtime, 文件名集合, 上次检查的时间]
+        self.lock = threading.Lock()
+
+    def load(self, d):
+        """读取xx子目录"""
+        path = os.path.join(self.path, d)
+        now = time.monotonic()
+        try:
+            # 先取mtime再listdir，之后的改动一定会被发现
+            mtime = os.stat(path).st_mtime_ns
+            names = set(f for f in os.listdir(path) if len(f) == 38)
+        except (FileNotFoundError, NotADirectoryError):
+            mtime = None
+            names = set()
+
+        with self.lock:
+            self.dirs[d] = entry = [mtime, names, now]
+        return entry
+
+    def refresh(self, d, entry, fresh=False):
+        """子目录被别人修改过的话重新读取"""
+        now = time.monotonic()
+        if not fresh and now - entry[2] < LOOSE_INDEX_TTL:
+            return entry
+        try:
+            mtime = os.stat(os.path.join(self.path, d)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == entry[0]:
+            entry[2] = now
+            return entry
+        return self.load(d)
+
+    def contains(self, sha, fresh=False):
+        d = sha[:2]
+        entry = self.dirs.get(d)
+        if entry is None:
+            entry = self.load(d)
+        if sha[2:] in entry[1]:
+            return True
+        entry = self.refresh(d, entry, fresh)
+        return sha[2:] in entry[1]
+
+    def add(self, sha):
+        """记录刚写入的对象"""
+        with self.lock:
+            entry = self.dirs.get(sha[:2])
+            # 还没读过的子目录不用管，读的时候自然会看到
+            if entry is not None and sha[2:] not in entry[1]:
+                entry[1].add(sha[2:])
+
+    def discard(self, sha):
+        """记录删除的对象"""
+        entry = self.dirs.get(sha[:2])
+        if entry is not None:
+            entry[1].discard(sha[2:])
+
+    def prefix(self, prefix):
+        """以prefix开头（至少两个字符）的松散对象，只读取objects/xx这一个子目录"""
+        d = prefix[:2]
+        entry = self.dirs.get(d)
+        entry = self.load(d) if entry is None else self.refresh(d, entry)
+        rest = prefix[2:]
+        return [ d + name for name in list(entry[1]) if name.startswith(rest) ]
+
+    def ids(self):
+        """所有松散对象的id"""
+        if not os.path.isdir(self.path):
+            return
+        for d in sorted(os.listdir(self.path)):
+            if len(d) != 2:
+                continue
+            entry = self.dirs.get(d)
+            entry = self.load(d) if entry is None else self.refresh(d, entry)
+            for name in list(entry[1]):
+                yield d + name
+
+def loose_index(repo):
+    """返回每个对象目录的GitLooseIndex，和object_dirs(repo)的顺序一致"""
+    if repo.loose_index is None:
+        repo.loose_index = [ GitLooseIndex(path) for path in object_dirs(repo) ]
+    return repo.loose_index
+
+def pack_entry_header(data, offset):
+    """读取pack中offset处对象的头部，返回 (类型, 大小, 基对象, 数据开始的位置)
+    基对象对OFS_DELTA来说是基对象在pack中的偏移，对REF_DELTA来说是基对象的sha"""
+    buf = data[offset:offset+32]
+
+    # 第一个字节: [继续位] [3位类型] [大小的低4位]，之后的字节每个7位
+    c = buf[0]
+    typ = (c >> 4) & 7
+    size = c & 0x0f
+    shift = 4
+    i = 1
+    while c & 0x80:
+        c = buf[i]
+        i += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+
+    base = None
+    if typ == PACK_OBJ_OFS_DELTA:
+        # 负偏移的编码方式和上面不同: 每多一个字节都要先加1
+        c = buf[i]
+        i += 1
+        ofs = c & 0x7f
+        while c & 0x80:
+            c = buf[i]
+            i += 1
+            ofs = ((ofs + 1) << 7) | (c & 0x7f)
+        base = offset - ofs
+    elif typ == PACK_OBJ_REF_DELTA:
+        base = buf[i:i+20].hex()
+        i += 20
+
+    return typ, size, base, offset + i
+
+def pack_inflate(pack, offset, size):
+    """从offset开始解压一段zlib数据（压缩后的长度事先不知道）"""
+    data = b''.join(inflate_view(pack.data, offset))
+
+    if len(data) != size:
+        raise Exception("文件校验失败")
+    return data
+
+def pack_stream(repo, pack, offset):
+    """流式读取pack中的对象，返回 (类型, 大小, 内容的迭代器)。
+    只有完整对象能直接流式解压，delta需要完整的基对象，只能整个读出来"""
+    typ, size, base, start = pack_entry_header(pack.data, offset)
+
+    if typ not in pack_type_fmt:
+        fmt, data = pack_read(repo, pack, offset)
+        return fmt, len(data), iter([data[i:i+STREAM_CHUNK] for i in range(0, len(data), STREAM_CHUNK)])
+
+    return pack_type_fmt[typ], size, stream_check(inflate_view(pack.data, start), size)
+
+def pack_header(repo, pack, offset):
+    """返回pack中offset处对象的 (类型, 大小)"""
+    typ, size, base, start = pack_entry_header(pack.data, offset)
+    if typ in pack_type_fmt:
+        return pack_type_fmt[typ], size
+
+    # delta数据的开头是两个变长整数: 基对象大小 和 结果大小，只解压到能读出它们为止
+    d = zlib.decompressobj()
+    head = b''
+    pos = start
+    while len([c for c in head if not c & 0x80]) < 2:
+        buf = d.unconsumed_tail or pack.data[pos:pos+64]
+        pos += len(buf)
+        if not buf or d.eof:
+            raise Exception("packfile被截断了")
+        head += d.decompress(buf, 32)
+    src_size, i = delta_varint(head, 0)
+    size, i = delta_varint(head, i)
+
+    # 类型和基对象一样，沿着delta链找到完整的对象
+    while typ not in pack_type_fmt:
+        if typ == PACK_OBJ_OFS_DELTA:
+            offset = base
+        elif typ == PACK_OBJ_REF_DELTA:
+            offset = pack.find(base)
+            if offset is None:
+                return object_header(repo, base)[0], size
+        else:
+            raise Exception("pack中有未知的对象类型{}".format(typ))
+        typ, _, base, _ = pack_entry_header(pack.data, offset)
 
-        # 读取并校验对象大小
-        y = raw.find(b'\x00' ,x)   # '\x00' 代表着null 字节,代表着终止符.
-        size = int(raw[x:y]).decode("ascii") # 读取大小 从空格开始到终止符结束就是文件的大小[本来应该是空格处索引+1,但是切片正好是左闭又开.结果是一样的.]
-        if size != len(raw)-y-1:
-            raise Exception("文件校验失败")
-        
-        if fmt == b'coomit':
-            c = GitCommit
-        elif fmt == b'blob':
-            c = GitBlob
-        elif fmt == b'tag':
-            c = GitTag
-        elif fmt == b'tree':
-            c = GitTree
+    return pack_type_fmt[typ], size
+
+def pack_read(repo, pack, offset):
+    """读取pack中offset处的对象，返回 (类型, 内容)。
+    delta链用循环而不是递归来处理: 先一路找到基对象，再把delta倒着依次应用上去。
+    重建过程中得到的每个对象都放进delta基对象缓存，沿着同一条链读下一个对象（比如一个文件的历史）时，
+    只要找到缓存中的基对象就可以停下，不用从头重建整条链"""
+    cache = repo.delta_base_cache
+    chain = list() # [(偏移, delta)]
+
+    while True:
+        if cache is not None:
+            found = cache.get((pack.packpath, offset))
+            if found is not None:
+                fmt, data = found
+                break
+
+        typ, size, base, start = pack_entry_header(pack.data, offset)
+
+        if typ == PACK_OBJ_OFS_DELTA:
+            chain.append((offset, pack_inflate(pack, start, size)))
+            offset = base
+        elif typ == PACK_OBJ_REF_DELTA:
+            chain.append((offset, pack_inflate(pack, start, size)))
+            offset = pack.find(base)
+            if offset is None:
+                # 基对象不在这个pack里（thin pack），从仓库的其他地方读取
+                fmt, data = object_read_raw(repo, base)
+                break
+        elif typ in pack_type_fmt:
+            fmt = pack_type_fmt[typ]
+            data = pack_inflate(pack, start, size)
+            if cache is not None and chain:
+                cache.put((pack.packpath, offset), fmt, data)
+            break
         else:
-            raise Exception("{}是未知的类型{}".format(fmt.decode("ascii"), sha))
+            raise Exception("pack中有未知的对象类型{}".format(typ))
+
+    for offset, delta in reversed(chain):
+        data = delta_apply(data, delta)
+        if cache is not None:
+            cache.put((pack.packpath, offset), fmt, data)
+
+    return fmt, data
+
+def delta_varint(delta, i):
+    """读取delta头部的变长整数（小端，每个字节7位）"""
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[i]
+        i += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, i
+
+def delta_apply(base, delta):
+    """把delta应用到base上
+    delta格式: [base大小] [结果大小] 然后是一串指令:
+    - 最高位为1: 从base复制。低4位表示后面有哪几个字节的offset，接着3位表示哪几个字节的size（size为0表示0x10000）
+    - 最高位为0: 把后面的n个字节直接插入（n是这个字节本身）"""
+    src_size, i = delta_varint(delta, 0)
+    dst_size, i = delta_varint(delta, i)
+
+    if src_size != len(base):
+        raise Exception("delta的基对象大小不匹配")
+
+    ret = list()
+    n = len(delta)
+    while i < n:
+        c = delta[i]
+        i += 1
+        if c & 0x80:
+            ofs = 0
+            for shift in (0, 8, 16, 24):
+                if c & 1:
+                    ofs |= delta[i] << shift
+                    i += 1
+                c >>= 1
+            size = 0
+            for shift in (0, 8, 16):
+                if c & 1:
+                    size |= delta[i] << shift
+                    i += 1
+                c >>= 1
+            if size == 0:
+                size = 0x10000
+            ret.append(base[ofs:ofs+size])
+        elif c:
+            ret.append(delta[i:i+c])
+            i += c
+        else:
+            raise Exception("delta中有无效的指令")
+
+    ret = b''.join(ret)
+    if len(ret) != dst_size:
+        raise Exception("delta应用后的大小不匹配")
+    return ret
+
+# delta编码
+# 和delta_apply使用同样的指令格式。对base按DELTA_BLOCK大小的块建立索引，
+# 在target上用滚动hash逐字节滑动窗口查找，找到相同的块后向前后尽量扩展（贪心地取最长的匹配），输出复制指令，
+# 没有匹配的部分输出插入指令。
+# 块大小是16字节，所以滚动hash直接用块内容本身对应的128位整数: 每前进一个字节就是左移8位再加上新字节，
+# 不会有hash冲突，base中块的hash就是int.from_bytes(块)。
+
+DELTA_BLOCK = 16 # 在base中建立索引的块大小
+DELTA_MASK = (1 << (8*DELTA_BLOCK)) - 1
+
+def delta_varint_encode(n):
+    ret = bytearray()
+    while n >= 0x80:
+        ret.append((n & 0x7f) | 0x80)
+        n >>= 7
+    ret.append(n)
+    return ret
+
+def delta_index(base):
+    """base中每个对齐的块 -> 它第一次出现的位置"""
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(int.from_bytes(base[i:i+DELTA_BLOCK], "big"), i)
+    return index
+
+def delta_create(base, target, max_size=None, index=None):
+    """生成把base变成target的delta（delta_apply的逆操作）
+    delta超过max_size时提前放弃，返回None
+    index是delta_index(base)，同一个base要和很多target比较时（pack_write的窗口）只需要建立一次"""
+    if index is None:
+        index = delta_index(base)
+
+    out = delta_varint_encode(len(base)) + delta_varint_encode(len(target))
+    n = len(target)
+    pending = 0 # 还没有输出的插入数据的开始位置
+    i = 0 # 下一个进入滚动窗口的字节
+    h = 0 # 窗口中DELTA_BLOCK个字节的滚动hash
+    filled = 0
+    while i < n:
+        # 待插入的数据迟早要输出，一直找不到匹配的候选不用扫描到最后
+        if max_size is not None and len(out) + (i - pending) > max_size:
+            return None
+        h = ((h << 8) | target[i]) & DELTA_MASK
+        i += 1
+        filled += 1
+        if filled < DELTA_BLOCK:
+            continue
+
+        ofs = index.get(h)
+        if ofs is None:
+            continue
+        start = i - DELTA_BLOCK
+
+        # 向后扩展
+        size = DELTA_BLOCK
+        while (start+size < n and ofs+size < len(base)
+               and target[start+size:start+size+64] == base[ofs+size:ofs+size+64]):
+            size += 64
+        size = min(size, n-start, len(base)-ofs)
+        while start+size < n and ofs+size < len(base) and target[start+size] == base[ofs+size]:
+            size += 1
+
+        # 向前扩展，吃掉一部分待插入的数据
+        while start > pending and ofs > 0 and target[start-1] == base[ofs-1]:
+            start -= 1
+            ofs -= 1
+            size += 1
+
+        delta_insert(out, target[pending:start])
+        delta_copy(out, ofs, size)
+        if max_size is not None and len(out) > max_size:
+            return None
+
+        i = pending = start + size
+        h = filled = 0
+
+    delta_insert(out, target[pending:])
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def delta_insert(out, data):
+    # 一条插入指令最多127个字节
+    for i in range(0, len(data), 0x7f):
+        chunk = data[i:i+0x7f]
+        out.append(len(chunk))
+        out += chunk
+
+def delta_copy(out, ofs, size):
+    # 一条复制指令最多0x10000个字节
+    while size:
+        n = min(size, 0x10000)
+        cmd = 0x80
+        args = bytearray()
+        for i in range(4):
+            if (ofs >> (8*i)) & 0xff:
+                cmd |= 1 << i
+                args.append((ofs >> (8*i)) & 0xff)
+        if n != 0x10000:
+            for i in range(3):
+                if (n >> (8*i)) & 0xff:
+                    cmd |= 1 << (4+i)
+                    args.append((n >> (8*i)) & 0xff)
+        out.append(cmd)
+        out += args
+        ofs += n
+        size -= n
 
-        # 调用构造函数并返回对象
-        return c(repo, raw[y+1:])
 
 # 
 def object_find(repo, name, fmt=None, follow=True):
@@ -263,7 +1209,8 @@ def object_find(repo, name, fmt=None, follow=True):
 # 1. 计算出hash -> 2. 根据hash 得到flag和大小 -> 3. zlib压缩所有内容 -> 4. 将结果写入
 # 警告:只有将flag 和大小合并起来才能购计算处hash(读取操作将他们分开了,需要复原还能得到准确的hash)
 
-def object_writer(obj, actually_write=True):
+def object_writer(obj, actually_write=True, writes=None):
+    """writes是限制同时写文件个数的信号量（批量写入时使用），压缩不受它限制"""
     # 序列化对象
     data = obj.serialize()
     # 复原 flag和size e.g. 
@@ -271,16 +1218,95 @@ def object_writer(obj, actually_write=True):
     # 计算出hash
     sha = hashlib.sha1(result).hexdigest()
 
-    if actually_write:
-        # 根据hash 计算出路径
-        path = repo(obj.repo, "objects", sha[0:2], sha[2:], mkdir=actually_write)
+    # 对象已经存在（松散的或者在pack里）就不用再压缩和写入了
+    if actually_write and not object_exists(obj.repo, sha):
+        # 压缩
+        result = zlib.compress(result, compression_level(obj.repo, obj.fmt, data[:ENTROPY_SAMPLE]))
 
-        with open(path, 'wb') as f:
-            # 压缩并写入
-            f.write(zlib.compress(result))
+        if writes:
+            with writes:
+                object_write_loose(obj.repo, sha, result)
+        else:
+            object_write_loose(obj.repo, sha, result)
         
     return sha
 
+def object_write_loose(repo, sha, compressed):
+    """把压缩好的对象写到 objects/xx/yyyy"""
+    # 根据hash 计算出路径
+    path = repo_dir(repo, "objects", sha[0:2], mkdir=True)
+
+    # 先写到同一个目录下的临时文件，写完再rename，中途崩溃不会留下损坏的对象
+    fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compressed)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, os.path.join(path, sha[2:]))
+    except BaseException:
+        os.remove(tmp)
+        raise
+    loose_index(repo)[0].add(sha)
+    object_ids_add(repo, sha)
+
+# 批量写入
+# 一次产生很多对象的操作（批量add、构造tree、导入）如果一个一个调用object_writer，只有一个核在跑zlib。
+# object_writer_batch在线程池里序列化、计算hash和压缩（hashlib和zlib会释放GIL），
+# 写文件另外用一个信号量限制同时进行的个数，避免太多线程同时抢磁盘。返回的sha和输入的顺序一致。
+
+def object_writer_batch(repo, objs, jobs=None, write_jobs=4):
+    # 先在主线程里加载pack列表和松散对象索引，避免多个线程同时初始化repo.packs和repo.loose_index
+    pack_list(repo)
+    loose_index(repo)
+    writes = threading.BoundedSemaphore(write_jobs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(lambda obj: object_writer(obj, writes=writes), objs))
+
+# 压缩级别
+# 和git一样: 松散对象用core.looseCompression（默认1，最快），pack用pack.compression，
+# 没有设置时都退回到core.compression（默认-1，也就是zlib的默认级别6）。
+# 还可以在[compression]里给每种类型单独设置，例如 blob = 1。
+# 没有单独设置的blob会先看一下开头的内容: 熵接近8 bit/字节（已经压缩过的图片、视频、压缩包）时直接用级别0存储，
+# 再压缩也不会变小，只是浪费CPU。
+
+ENTROPY_SAMPLE = 65536 # 估算熵时取样的字节数
+ENTROPY_MIN = 4096 # 太小的对象不值得估算
+ENTROPY_LIMIT = 7.5 # 超过这个值（bit/字节）就认为是不可压缩的
+
+def compression_level(repo, fmt, sample=b'', loose=True):
+    """根据配置和内容取样选择zlib压缩级别"""
+    conf = repo.conf
+    level = conf.get("compression", fmt.decode("ascii"), fallback=None)
+    if level is not None:
+        return int(level)
+
+    if fmt == b'blob' and len(sample) >= ENTROPY_MIN and byte_entropy(sample) > ENTROPY_LIMIT:
+        return 0
+
+    if loose:
+        level = conf.get("core", "loosecompression", fallback=None)
+    else:
+        level = conf.get("pack", "compression", fallback=None)
+    if level is None:
+        level = conf.get("core", "compression", fallback=None)
+    if level is None:
+        return 1 if loose else -1
+    return int(level)
+
+def byte_entropy(data):
+    """按字节统计的香农熵（bit/字节）"""
+    n = len(data)
+    return -sum(c/n * math.log2(c/n) for c in collections.Counter(data).values())
+
+def object_exists(repo, sha):
+    """对象是否已经在仓库中（松散对象或者pack中，包括alternates）"""
+    if object_path(repo, sha):
+        return True
+
+    pack, offset = pack_find(repo, sha)
+    return pack is not None
+
 
 # blob类型 - 仅存储一个文件的内容，包括文件名等其他信息。
 # 然后将这些信息经过SHA1哈希算法得到对应的哈希值作为这个object在Git仓库中的唯一身份证。
@@ -303,20 +1329,113 @@ argsp = argsubparsers.add_parser("cat-file", help = "查看这个仓库对象的
 
 argsp.add_argument("type", 
                     metavar="type",
+                    nargs="?",
                     choices=["blob", "commit", "tag", "tree"],
                     help = "该类型的说明" )
 
 argsp.add_argument("object",
                   metavar = "object",
+                  nargs="?",
                   help = "要显示的对象")
 
+argsp.add_argument("-t",
+                   dest="show_type",
+                   metavar="object",
+                   help="只显示对象的类型")
+
+argsp.add_argument("-s",
+                   dest="show_size",
+                   metavar="object",
+                   help="只显示对象的大小")
+
+argsp.add_argument("--batch",
+                   action="store_true",
+                   help="从标准输入读取对象名，输出每个对象的类型、大小和内容")
+
+argsp.add_argument("--batch-check",
+                   dest="batch_check",
+                   action="store_true",
+                   help="从标准输入读取对象名，只输出每个对象的类型和大小")
+
+argsp.add_argument("--batch-all-objects",
+                   dest="batch_all",
+                   action="store_true",
+                   help="不读标准输入，输出仓库中的所有对象（默认和--batch-check一样）")
+
+argsp.add_argument("--unordered",
+                   action="store_true",
+                   help="和--batch-all-objects一起使用，按pack中的顺序而不是hash的顺序输出")
+
 def cmd_cat_file(args):
-    repo = repo_find()
-    cat_file(repo, args.objeect, fmt=args.type.encode())
+    if args.batch_all:
+        repo = repo_find()
+        cat_file_batch(repo, object_iter(repo, args.unordered), contents=args.batch)
+        return
+
+    if args.batch or args.batch_check:
+        # 批量模式会读很多对象，打开缓存
+        repo = repo_find()
+        cat_file_batch(repo, sys.stdin, contents=args.batch)
+        return
+
+    if args.show_type or args.show_size:
+        repo = repo_find(cache=False)
+        fmt, size = object_header(repo, object_find(repo, args.show_type or args.show_size))
+        print(fmt.decode("ascii") if args.show_type else size)
+        return
+
+    if not (args.type and args.object):
+        raise Exception("需要指定type和object")
+
+    repo = repo_find(cache=False)
+    cat_file(repo, args.object, fmt=args.type.encode())
 
 def cat_file(repo, obj, fmt=None):
-    obj = obj_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # 按块输出，不把整个对象读进内存
+    fmt, size, stream = object_stream(repo, object_find(repo, obj, fmt=fmt))
+    for chunk in stream:
+        sys.stdout.buffer.write(chunk)
+
+# cat-file --batch / --batch-check
+# 工具每查一个对象就启动一次进程，要付出解释器启动、构造argparse、repo_find和读取配置的代价。
+# 批量模式从标准输入每行读一个对象名，所有对象共用一个GitRepository（和它的缓存），输出格式和git一致:
+# <sha> <类型> <大小>\n<内容>\n  （--batch-check 没有内容部分）
+# 对象名和其他命令一样用object_find解析（也支持 rev:path），解析失败或者对象不存在时输出 <name> missing，短hash有歧义时输出 <name> ambiguous
+
+def cat_file_batch(repo, names, contents=True):
+    out = sys.stdout.buffer
+    for line in names:
+        name = line.strip()
+        if not name:
+            continue
+
+        # 一行出错（ref不存在、路径不存在……）不能让整个批量进程退出
+        try:
+            shas = None if ":" in name else object_resolve(repo, name)
+            if shas and len(shas) > 1:
+                out.write("{} ambiguous\n".format(name).encode())
+                out.flush()
+                continue
+            sha = object_find(repo, name)
+            if not object_exists(repo, sha):
+                sha = None
+        except Exception:
+            sha = None
+
+        if sha is None:
+            out.write("{} missing\n".format(name).encode())
+        elif not contents:
+            fmt, size = object_header(repo, sha)
+            out.write("{} {} {}\n".format(sha, fmt.decode("ascii"), size).encode())
+        else:
+            fmt, size, stream = object_stream(repo, sha)
+            out.write("{} {} {}\n".format(sha, fmt.decode("ascii"), size).encode())
+            for chunk in stream:
+                out.write(chunk)
+            out.write(b'\n')
+
+        # 每个对象输出完就flush，调用方可以一问一答地使用
+        out.flush()
 
 # git hash-object [-W] [-t TYPE] file 命令
 # 和cat-file 相反。 读取文件，将hash计算为object。存储到GitRepository
@@ -332,25 +1451,65 @@ argsp.add_argument('-t',
 )
 
 argsp.add_argument('-w',
-                   dest="type",
+                   dest="write",
                    action = "store_true",
                    help="将对象写入数据库")
 
+argsp.add_argument("--stdin-paths",
+                   dest="stdin_paths",
+                   action="store_true",
+                   help="从标准输入读取文件路径（每行一个），并行计算")
+
+argsp.add_argument("-j", "--jobs",
+                   type=int,
+                   default=os.cpu_count(),
+                   help="--stdin-paths 时使用的线程数")
+
 argsp.add_argument("path",
+                   nargs="?",
                    help="Read object from <file>")
 
 
 def cmd_hash_object(args):
-    if agrs.write:
-        repo = GitRepository(".")
+    if args.write:
+        repo = GitRepository(".", cache=False)
     else:
         repo = None
+
+    if args.stdin_paths:
+        paths = [ line.rstrip("\n") for line in sys.stdin ]
+        for sha in object_hash_paths(paths, args.type.encode(), repo, args.jobs):
+            print(sha)
+        return
+
+    if not args.path:
+        raise Exception("需要指定文件路径")
     
     with open(args.path, "rb") as f:
         sha = object_hash(f, args.type.encode(), repo)
         print(sha)
 
+def object_hash_path(path, fmt, repo=None):
+    with open(path, "rb") as f:
+        return object_hash(f, fmt, repo)
+
+def object_hash_paths(paths, fmt, repo=None, jobs=None):
+    """用线程池计算（并写入）多个文件，按输入的顺序返回sha。
+    hashlib和zlib处理大块数据时会释放GIL，所以线程就能用满多个核"""
+    if repo:
+        # 先在主线程里加载pack列表和松散对象索引，避免多个线程同时初始化repo.packs和repo.loose_index
+        pack_list(repo)
+        loose_index(repo)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        # map 按提交的顺序返回结果
+        yield from pool.map(lambda path: object_hash_path(path, fmt, repo), paths)
+
 def object_hash(f, fmt, repo=None):
+    if fmt==b'blob' and stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        # blob不需要解析，直接流式计算
+        return object_hash_stream(f, fmt, repo)
+
     data = f.read()
     
     if fmt==b'commit':
@@ -366,6 +1525,57 @@ def object_hash(f, fmt, repo=None):
     
     return object_writer(obj, repo)
 
+def object_hash_stream(f, fmt, repo=None):
+    """流式计算文件的hash，repo不为None时同时写入仓库。
+    大小从fstat得到，头部和之后的每一块同时送进sha1和zlib，压缩结果先写到临时文件，
+    知道hash以后再rename到对应的位置，所以不会把整个文件读进内存"""
+    size = os.fstat(f.fileno()).st_size
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    h = hashlib.sha1(header)
+
+    # 第一块也用来选择压缩级别
+    chunk = f.read(STREAM_CHUNK)
+
+    out = None
+    tmp = None
+    if repo:
+        fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects", mkdir=True))
+        out = os.fdopen(fd, "wb")
+        z = zlib.compressobj(compression_level(repo, fmt, chunk[:ENTROPY_SAMPLE]))
+        out.write(z.compress(header))
+
+    try:
+        n = 0
+        while chunk:
+            n += len(chunk)
+            h.update(chunk)
+            if out:
+                out.write(z.compress(chunk))
+            chunk = f.read(STREAM_CHUNK)
+
+        if n != size:
+            raise Exception("{}在读取时被修改了".format(f.name))
+
+        sha = h.hexdigest()
+
+        if out:
+            out.write(z.flush())
+            out.close()
+            out = None
+            if not object_exists(repo, sha):
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True))
+                tmp = None
+                loose_index(repo)[0].add(sha)
+                object_ids_add(repo, sha)
+    finally:
+        if out:
+            out.close()
+        if tmp:
+            os.remove(tmp)
+
+    return sha
+
 
 # 解析 cmmits
 # 格式是邮件消息的简化版本，它以一系列键值对开始，以空格作为键/值分隔符，最后以提交消息结束。
@@ -382,90 +1592,208 @@ def object_hash(f, fmt, repo=None):
 # 值得注意的是，如果消息有多行，会分行显示，行头有个空格(如上面的例子所示)
 # 如果将函数命名为commit_parse 会引起混淆 因为commit 和commit_parse 是两种类型
 
-def kvlm_parse(raw, start=0, dct=None):
+def kvlm_parse(raw, start=0):
     """
     Key-Value List with Message
-    dct 中就像这样
+    返回的dict 中就像这样
     {
-        'tree':'29ff16c9c14e2652b22f8b78bb08a5a07930c147',
-        'parent':'206941306e8a8af65b66eaaaea388a7ae24d49a0',
-        'author':'Thibault Polge <thibault@thb.lt> 1527025023 +0200',
-        'committer':'Thibault Polge <thibault@thb.lt> 1527025044 +0200'
+        b'tree': b'29ff16c9c14e2652b22f8b78bb08a5a07930c147',
+        b'parent': b'206941306e8a8af65b66eaaaea388a7ae24d49a0',
+        b'author': b'Thibault Polge <thibault@thb.lt> 1527025023 +0200',
+        b'committer': b'Thibault Polge <thibault@thb.lt> 1527025044 +0200',
+        b'': b'Create first draft'
     }
+    同一个键出现多次（例如合并提交的parent）时值是一个列表。
 
+    逐行扫描一遍: 行头是空格的是上一个值的连续行（gpgsig、mergetag这种很长的值），
+    把这些行去掉行头的空格再用换行连起来；遇到空行，剩下的全部是消息。
     """
-    if not dct:
-        dct = collections.OrderedDict()
-        # 你不能在参数声明中将dct 声明为OrderedDict。
-        # 这样每次调用都会生成一个一样的dict
-    
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    # 如果空格出现在换行符之前，则有一个关键字（上面例子中的tree commit 等均是空格在换行符之前）
-
-    # 基底
-    # 如果换行符首先出现（或者没有空格，这种情况返回-1）
-    # 空行代表着剩下的部分就是消息
-    if (spc < 0) or (nl < spc):
-        assert(nl == start)
-        dct[b''] = raw[start+1:]
-        return dct
-    
-    # 递归的情况
-    # 我们读取的这个键值对 
-    key = raw[start:spc]
-    
-    # 继续递归
-    # 查找值的结尾，从有空格的行开始，直到我们找到一个"\n"没有跟空格为止 (整个消息段)
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
-
-    # 获取消息
-    # 在连续行的行头删除掉空格
-    value = raw[spc+1:end].replace(b'\n', b'\n')
-
+    # memoryview没有find，先转成bytes
+    if not isinstance(raw, bytes):
+        raw = bytes(raw)
+
+    dct = dict()
+    find = raw.find
+    end = len(raw)
+    key = None # 正在读取的键
+    lines = None # 它的值的各行
+
+    while start < end:
+        nl = find(b'\n', start)
+        if nl < 0:
+            nl = end
+
+        if raw[start] == 0x20:
+            # 连续行
+            if key is None:
+                raise Exception("格式错误: 第一行不能是连续行")
+            lines.append(raw[start+1:nl])
+            start = nl + 1
+            continue
+
+        if key is not None:
+            kvlm_add(dct, key, b'\n'.join(lines) if len(lines) > 1 else lines[0])
+            key = None
+
+        if nl == start:
+            # 空行，之后是消息
+            dct[b''] = raw[nl+1:]
+            return dct
+
+        spc = find(b' ', start, nl)
+        if spc < 0:
+            raise Exception("格式错误: 没有值的行{}".format(raw[start:nl]))
+        key = raw[start:spc]
+        lines = [ raw[spc+1:nl] ]
+        start = nl + 1
+
+    if key is not None:
+        kvlm_add(dct, key, b'\n'.join(lines) if len(lines) > 1 else lines[0])
+    dct[b''] = b''
+    return dct
+
+def kvlm_add(dct, key, value):
     # 不要重写已经存在的数据
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
-        else:
-            dct[key] = [ dct[key], value]
-    else:
+    old = dct.get(key)
+    if old is None:
         dct[key] = value
-    
-    return kvlm_parse(raw, start=end+1, dct=dct)
+    elif type(old) == list:
+        old.append(value)
+    else:
+        dct[key] = [ old, value ]
 
 # 考虑到cat-file 命令，我们还需要还原对象来打印输出到屏幕
 def kvlm_serialize(kvlm):
-    ret = b''
+    parts = list()
 
     # 输出字段
-    for i in kvlm.keys():
+    for k, val in kvlm.items():
         # 跳过消息本身
-        if k == b'':continue
-        val = kvlm[k]
-        # 添加到列表
+        if k == b'':
+            continue
         if type(val) != list:
             val = [val]
         for v in val:
-            ret += k + b' ' + (v.repalce(b'\n')) + b'\n'
-    
+            # 值中的换行后面要加空格，变成连续行
+            parts += (k, b' ', v.replace(b'\n', b'\n '), b'\n')
+
     # 添加消息
-    ret += b'\n' + kvlm[b'']
+    parts += (b'\n', kvlm.get(b'', b''))
+    return b''.join(parts)
 
 
 # Commit 对象
+# 遍历历史的时候每个commit通常只需要parent（有时候还有tree或者时间），不需要签名和消息。
+# GitCommit只保存原始数据，第一次访问某个字段时扫描一遍头部，记下每个字段的位置（不复制任何值），
+# tree、parents、author/committer和message各自在用到时才从原始数据中切出来。
+# 需要全部字段时还可以用kvlm（第一次访问时才调用kvlm_parse）。kvlm解析出来以后可能被就地修改，
+# 之后的字段和serialize都以kvlm为准。
 class GitCommit(GitObject):
+    __slots__ = ("raw", "offsets", "message_start", "_kvlm")
     fmt = b'commit'
 
+    def __init__(self, repo, data=None):
+        GitObject.__init__(self, repo, b'' if data is None else data)
+
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.raw = data
+        self.offsets = None # [(键, 值开始的位置, 值结束的位置)]
+        self.message_start = None
+        self._kvlm = None
 
     def serialize(self):
-        return kvlm_serialize(self.kvlm)
+        if self._kvlm is not None:
+            return kvlm_serialize(self._kvlm)
+        return self.raw
+
+    def index(self):
+        """记录每个头部字段的位置"""
+        raw = self.raw
+        find = raw.find
+        end = len(raw)
+        offsets = list()
+        start = 0
+        while start < end and raw[start] != 0x0a:
+            nl = find(b'\n', start)
+            if nl < 0:
+                nl = end
+            spc = find(b' ', start, nl)
+            if spc < 0:
+                raise Exception("格式错误: 没有值的行{}".format(raw[start:nl]))
+            # 跳过连续行
+            while nl + 1 < end and raw[nl+1] == 0x20:
+                nl = find(b'\n', nl+1)
+                if nl < 0:
+                    nl = end
+            offsets.append((raw[start:spc], spc+1, nl))
+            start = nl + 1
+        self.offsets = offsets
+        self.message_start = min(start+1, end)
+
+    def header(self, key):
+        """返回键为key的所有值"""
+        if self._kvlm is not None:
+            values = self._kvlm.get(key, [])
+            return values if type(values) == list else [values]
+        if self.offsets is None:
+            self.index()
+        raw = self.raw
+        return [ raw[start:end].replace(b'\n ', b'\n') for k, start, end in self.offsets if k == key ]
+
+    def header_one(self, key):
+        values = self.header(key)
+        if not values:
+            raise Exception("没有{}字段".format(key.decode("ascii")))
+        return values[0]
+
+    @property
+    def tree(self):
+        return self.header_one(b'tree').decode("ascii")
+
+    @property
+    def parents(self):
+        return [ p.decode("ascii") for p in self.header(b'parent') ]
+
+    @property
+    def author(self):
+        return self.header_one(b'author')
+
+    @property
+    def committer(self):
+        return self.header_one(b'committer')
+
+    @property
+    def author_time(self):
+        return signature_time(self.author)
+
+    @property
+    def committer_time(self):
+        return signature_time(self.committer)
+
+    @property
+    def message(self):
+        if self._kvlm is not None:
+            return self._kvlm.get(b'', b'')
+        if self.message_start is None:
+            self.index()
+        return self.raw[self.message_start:]
+
+    @property
+    def kvlm(self):
+        if self._kvlm is None:
+            self._kvlm = kvlm_parse(self.raw)
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, kvlm):
+        # 修改后重新序列化，保持只有一种表示
+        self.deserialize(kvlm_serialize(kvlm))
+
+def signature_time(sig):
+    """author/committer的时间戳，格式是 名字 <邮箱> 时间戳 时区"""
+    return int(sig.rsplit(b' ', 2)[1])
     
 
 # 日志命令
@@ -493,19 +1821,10 @@ def log_graphviz(repo, sha, seen):
     seen.add(sha)
 
     commit = object_read(repo, sha)
-    assert (commit.fmt == b'coomit')
-
-    if not b'parent' in commit.kvlm.keys():
-        # 基底条件
-        return 
-    
-    parents = coomit.kvlm[b'parent']
-    
-    if type(parents) != list:
-        parents = [parents]
+    assert (commit.fmt == b'commit')
 
-    for p in parents:
-        p = p.decode('ascii')
+    # 只需要parent，不解析其他字段
+    for p in commit.parents:
         print("c_{0} -> c_{1};".format(sha, p))
         log_graphviz(repo, p, seen)
 
@@ -531,68 +1850,120 @@ def log_graphviz(repo, sha, seen):
 # [mode] space [path] 0x00 [sha-1]
 
 # 解析树
+# 每个条目只在原始数据里用find找两次分隔符（空格和NUL），按位置切出mode、path和20字节的二进制sha，
+# 16进制字符串只在用到leaf.sha时才转换。大的树（几万个条目）checkout和ls-tree的时间主要就花在这里。
 class GitTreeLeaf(object):
-    def __init__(self, mode, path, sha):
+    __slots__ = ("mode", "path", "oid")
+
+    def __init__(self, mode, path, oid):
         self.mode = mode
         self.path = path
-        self.sha = sha
-    
-def tree_parse_one(self, start=0):
-    # 找到mode后的空格
-    x = raw.find(b' ',start)
-    assert(x-start == 5 or x-start == 6)
-
-    # 读取mode
-    mode = raw[start:x]
-
-    # 找到后面的那个null值
-    y = raw.find(b'\x00', x)
-    # 读取 Path
-    path = raw[x+1:y]
-
-    # 读取sha 并转成16进制字符串 sha-1 结构形式是大端序列
-    # sha = hex(
-    #     int.from_bytes(
-    #         raw[y+1:y+21], "big"))[2:] # big 代表着的大端
-    #         # 这里从2开始切片的原因是因为
-    #         # 默认16进制前面会加0x 我们并不需要这个
-    #  return y+21,GitTreeLeaf(mode, path, sha)   
-    sha = hex(
-        int.from_bytes(
-            raw[y+1:y+21], "big"))[2:] # hex() adds 0x in front,
-                                        # we don't want that.
-    return y+21, GitTreeLeaf(mode, path, sha)
+        self.oid = oid # 20字节的二进制sha
+
+    @property
+    def sha(self):
+        """16进制的sha（用到时才转换）"""
+        return self.oid.hex()
+
+def tree_parse_entries(raw, start=0):
+    """遍历树对象的原始数据，对每个条目给出 (开始位置, mode后空格的位置, path后NUL的位置)
+    mode是raw[start:x]，path是raw[x+1:y]，sha是raw[y+1:y+21]"""
+    find = raw.find
+    end = len(raw)
+    while start < end:
+        x = find(b' ', start)
+        y = find(b'\x00', x)
+        if x - start not in (5, 6) or y < 0 or y + 21 > end:
+            raise Exception("树对象格式错误（位置{}）".format(start))
+        yield start, x, y
+        start = y + 21
+
+def tree_parse_one(raw, start=0):
+    start, x, y = next(tree_parse_entries(raw, start))
+    return y+21, GitTreeLeaf(raw[start:x], raw[x+1:y], raw[y+1:y+21])
 
 def tree_parse(raw):
-    pos = 0
-    max = len(raw)
-    ret = list()
-    while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
-    
-    return ret
-
-def tree_serialize(obj):
-    
-    ret = b''
-    for i in obj.items():
-        ret += b' '
-        ret += i.path
-        ret += b'\x00'
-        sha = int(i.sha, 16)# 以16进制解析
-
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
-
+    # memoryview（例如mmap出来的数据）没有find，先转成bytes
+    if not isinstance(raw, bytes):
+        raw = bytes(raw)
+    return [ GitTreeLeaf(raw[start:x], raw[x+1:y], raw[y+1:y+21])
+             for start, x, y in tree_parse_entries(raw) ]
+
+def tree_leaf_sort_key(leaf):
+    """git中树的条目按path排序，但是子目录要当作后面有一个/来比较"""
+    if leaf.mode.startswith(b'4'):
+        return leaf.path + b'/'
+    return leaf.path
+
+def tree_serialize(items):
+    items = sorted(items, key=tree_leaf_sort_key)
+    return b''.join(b''.join((i.mode, b' ', i.path, b'\x00', i.oid)) for i in items)
+
+# GitTree不保存GitTreeLeaf的列表: 只保存原始数据和两个数组（每个条目mode后空格和path后NUL的位置），
+# 每个条目只占8个字节，10万个条目的树只比原始数据多不到1MB。GitTreeLeaf在用到时才从原始数据中切出来。
+# 条目本来就是按git的顺序排好的，查找单个条目可以二分查找。
 class GitTree(GitObject):
     fmt = b'tree'
+    raw = b'' # 原始数据
+    spaces = () # 每个条目mode后的空格的位置
+    nuls = () # 每个条目path后的NUL的位置，sha紧跟在后面，下一个条目从nul+21开始
 
     def deserialize(self, data):
-        self.items = tree_parse(data)
-    
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.raw = data
+        self.spaces = array.array("I")
+        self.nuls = array.array("I")
+        for start, x, y in tree_parse_entries(data):
+            self.spaces.append(x)
+            self.nuls.append(y)
+
     def serialize(self):
-        return tree_serialize(self)
+        return self.raw
+
+    def __len__(self):
+        return len(self.nuls)
+
+    def leaf(self, i):
+        """第i个条目"""
+        raw = self.raw
+        x = self.spaces[i]
+        y = self.nuls[i]
+        start = self.nuls[i-1] + 21 if i else 0
+        return GitTreeLeaf(raw[start:x], raw[x+1:y], raw[y+1:y+21])
+
+    @property
+    def items(self):
+        return [ self.leaf(i) for i in range(len(self)) ]
+
+    @items.setter
+    def items(self, items):
+        # 修改条目时重新序列化，保持只有一种表示
+        self.deserialize(tree_serialize(items))
+
+    def sort_key(self, i):
+        """第i个条目排序用的名字（子目录后面加/）"""
+        x = self.spaces[i]
+        y = self.nuls[i]
+        start = self.nuls[i-1] + 21 if i else 0
+        if self.raw[start] == ord('4'):
+            return self.raw[x+1:y] + b'/'
+        return self.raw[x+1:y]
+
+    def find(self, name):
+        """按名字查找条目，没有返回None
+        不知道name是文件还是子目录，两种排序的名字各二分查找一次"""
+        for key in (name, name + b'/'):
+            lo, hi = 0, len(self)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.sort_key(mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(self) and self.sort_key(lo) == key:
+                return self.leaf(lo)
+        return None
 
 argsp = argsubparsers.add_parser("ls-tree")
 argsp.add_argument("object",help="显示这个对象")
@@ -601,11 +1972,18 @@ def cmd_ls_tree(args):
     repo = repo_find()
     obj = object_read(repo, object_find(repo, args.object, fmt=b"tree"))
 
-    for item in obj.items():
+    for item in obj.items:
+        if item.mode == b'160000':
+            # 子模块指向的是别的仓库的commit
+            fmt = b'commit'
+        else:
+            # 只需要类型，不用解压整个对象
+            fmt, size = object_header(repo, item.sha)
+
         print("{0} {1} {2}\t{3}".format(
             "0"*(6-len(item.mode)) + item.mode.decode("ascii"),
             # Git的文件树显示所指向对象的类型。
-            object_read(repo, item.sha).fmt.decode("ascii"),
+            fmt.decode("ascii"),
             item.sha,
             item.path.decode("ascii")))
         
@@ -629,8 +2007,8 @@ def cmd_checkout(args):
     obj = object_read(repo, object_find(repo, args.commit))
 
     # 如果这个对象是commit类型,我们获得它的树对象
-    if obj.fmt == b'cocmmit':
-        obj = object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
+    if obj.fmt == b'commit':
+        obj = object_read(repo, obj.tree)
 
     # 检查目录是否是空目录
     if os.path.exists(args.path):
@@ -641,20 +2019,28 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
     
-    tree_checkout(repo, obj, os.path.replace(args.path).encode())
+    tree_checkout(repo, obj, os.path.realpath(args.path).encode())
 
 # 实际的功能
-def tree_checkout(repo, obj, path):
+def tree_checkout(repo, tree, path):
     for item in tree.items:
-        obj == object_read(repo, item.sha)
         dest = os.path.join(path, item.path)
 
-        if obj.fmt == b'tree':
+        if item.mode == b'160000':
+            # 子模块(gitlink)指向的是别的仓库的commit，和git一样只建一个空目录
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
+            continue
+
+        fmt, size, stream = object_stream(repo, item.sha)
+
+        if fmt == b'tree':
+            os.mkdir(dest)
+            tree_checkout(repo, GitTree(repo, b''.join(stream)), dest)
+        elif fmt == b'blob':
+            # blob按块写入，大文件也不会占用很多内存
             with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+                for chunk in stream:
+                    f.write(chunk)
 
 # Refs,tag and branches
 # ref 是指向git对象的指针, 每个commit对象都有唯一的key,这个唯一的key保存在某个文件里.
@@ -668,7 +2054,7 @@ def ref_resolve(repo,ref):
     with open(repo_file(repo, ref), 'r') as f:
         data = f.read()[:-1]
         # 去掉最后的换行符
-    if data.startwith("ref: "):
+    if data.startswith("ref: "):
         return ref_resolve(repo, data[5:])
     else:
         return data 
@@ -678,10 +2064,10 @@ def ref_list(repo, path=None):
         path = repo_dir(repo, "refs")
     ret = collections.OrderedDict()
     # git所展示的ref是有序的,所以这里我们用OrderDice
-    for f in sort(os.listdir(path)):
+    for f in sorted(os.listdir(path)):
         can = os.path.join(path, f)
         if os.path.isdir(can):
-            ret[f] = ref_list[f]
+            ret[f] = ref_list(repo, can)
         else:
             ret[f] = ref_resolve(repo, can)
     
@@ -718,6 +2104,7 @@ def show_ref(repo, refs, with_hash=True,prefix=""):
 # git tag 用来给一个comit 对象起一个别名 之后可以用这个别名引用它
 
 class GitTag(GitCommit):
+    __slots__ = ()
     fmt = b'tag'
 
 
@@ -765,8 +2152,7 @@ def object_resolve(repo, name):
     - branches
     - remote branches"""
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{1,16}$")
-    smallHashRE = re.compile(r"^[0-9A-Fa-f]{1,16}$")
+    hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
     # 空字符串
     if not name.strip():
@@ -776,33 +2162,153 @@ def object_resolve(repo, name):
     if name == "HEAD":
         return [ ref_resolve(repo, "HEAD") ]
     
-    if hashRE.math(name):
+    if hashRE.match(name):
+        name = name.lower()
         if len(name) == 40:
             # 这是完整的hash(hash)
-            return [ name.lower() ]
-        elif len(name) == 4:
-            # 这是短的hash(smallHash)
-
-            name = name.lower()
-            prefix = nmae[0:2]
-            path = repo_dir(repo, "objects", prefix, mkdir=False)
-            if path:
-                rem = name[2:]
-                for f in os.listdir(path):
-                    if f.startwith(rem):
-                        candidates.append(prefix + f)
+            return [ name ]
+
+        # 这是短的hash(smallHash)，在有序的对象id列表中二分查找
+        candidates = object_prefix_search(repo, name)
             
     return candidates
 
+# 短hash
+# idx和multi-pack-index中的sha本来就是排好序的，短hash直接在映射的表中二分查找前缀，
+# 松散对象只需要看objects/xx这一个子目录（GitLooseIndex），查找一个短hash是O(log n)，不用列出所有对象。
+
+def sha_table_bisect(table, key):
+    """在有fanout和sha(i)的有序表（GitPack或者GitMultiPackIndex）中，
+    返回第一个不小于key（整数）的位置和这个fanout区间的结尾"""
+    first = key >> 152
+    lo = table.fanout[first-1] if first else 0
+    end = hi = table.fanout[first]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if int.from_bytes(table.sha(mid), "big") < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo, end
+
+def sha_table_prefix(table, prefix):
+    """有序表中所有以prefix开头的sha"""
+    i, end = sha_table_bisect(table, int(prefix.ljust(40, "0"), 16))
+    ret = list()
+    while i < end:
+        sha = table.sha(i).hex()
+        if not sha.startswith(prefix):
+            break
+        ret.append(sha)
+        i += 1
+    return ret
+
+def sha_tables(repo):
+    """所有需要查找的有序表: multi-pack-index，以及不在其中的pack"""
+    packs = pack_list(repo)
+    return list(repo.midxs) + packs
+
+def object_prefix_search(repo, prefix):
+    """返回所有以prefix开头的对象id"""
+    ret = set()
+    for index in loose_index(repo):
+        ret.update(index.prefix(prefix))
+    for table in sha_tables(repo):
+        ret.update(sha_table_prefix(table, prefix))
+    return sorted(ret)
+
+def object_abbrev(repo, sha, length=7):
+    """返回sha最短的唯一缩写（至少length个字符）
+    和sha共同前缀最长的只可能是有序表中它前后的id，或者同一个objects/xx目录中的松散对象"""
+    others = list()
+    for index in loose_index(repo):
+        others += index.prefix(sha[:2])
+    key = int(sha, 16)
+    for table in sha_tables(repo):
+        i, end = sha_table_bisect(table, key)
+        for j in (i-1, i, i+1):
+            if 0 <= j < table.count:
+                others.append(table.sha(j).hex())
+
+    common = 0
+    for other in others:
+        if other != sha:
+            n = 0
+            while n < 40 and other[n] == sha[n]:
+                n += 1
+            common = max(common, n)
+
+    return sha[:max(length, common+1)]
+
+# 所有对象的有序列表，遍历所有对象（object_iter）时使用，第一次使用时建立，写入新对象时插入。
+
+def object_id_list(repo):
+    """返回仓库中所有对象id的有序列表"""
+    if repo.object_ids is None:
+        ids = set()
+
+        for index in loose_index(repo):
+            ids.update(index.ids())
+
+        for table in sha_tables(repo):
+            ids.update(table.shas())
+
+        repo.object_ids = sorted(ids)
+    return repo.object_ids
+
+def object_ids_add(repo, sha):
+    """新写入的对象加入有序列表（列表还没建立时什么也不做）"""
+    ids = repo.object_ids
+    if ids is not None:
+        # 批量写入时多个线程会同时插入
+        with loose_index(repo)[0].lock:
+            i = bisect.bisect_left(ids, sha)
+            if i == len(ids) or ids[i] != sha:
+                ids.insert(i, sha)
+
+# 遍历所有对象
+# 默认按hash排序（就是上面的有序列表）。unordered时按对象在pack中存放的顺序，
+# 接着读取内容时是顺序访问pack的，delta的基对象也通常就在前面，能命中delta_base_cache；最后是松散对象。
+# 同一个对象可能同时在多个pack中或者既是松散的又打包了，只输出一次。
+
+def object_iter(repo, unordered=False):
+    """遍历仓库中所有对象的id（松散的和pack中的，包括alternates）"""
+    if not unordered:
+        yield from object_id_list(repo)
+        return
+
+    seen = set()
+    for pack in pack_all(repo):
+        shas = pack.shas()
+        for i in sorted(range(pack.count), key=pack.offset):
+            if shas[i] not in seen:
+                seen.add(shas[i])
+                yield shas[i]
+
+    for index in loose_index(repo):
+        for sha in index.ids():
+            if sha not in seen:
+                seen.add(sha)
+                yield sha
+
 
 def object_find(repo, name, fmt=None, follow=True):
-    sha = object_resolve(repo, name)
+    if ":" in name:
+        # rev:path 是rev的树中path指向的对象
+        rev, path = name.split(":", 1)
+        tree = object_find(repo, rev, fmt=b'tree')
+        if tree is None:
+            raise Exception("{}不是commit或者树".format(rev))
+        sha = [ tree_lookup(repo, tree, path) ]
+    else:
+        sha = object_resolve(repo, name)
 
     if not sha:
         raise Exception("No such reference {0}.".format(name))
 
     if len(sha) > 1:
-        raise Exception("Ambiguous reference {0}: Candidates are:\n - {1}.".format(name,  "\n - ".join(sha)))
+        candidates = [ "{0} {1}".format(c, object_header(repo, c)[0].decode("ascii")) for c in sha ]
+        raise Exception("Ambiguous reference {0}: Candidates are:\n - {1}.".format(name,  "\n - ".join(candidates)))
 
     sha = sha[0]
 
@@ -810,22 +2316,42 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
+        # 只看类型的时候不读取整个对象（可能是很大的blob）
+        obj_fmt, size = object_header(repo, sha)
 
-        if obj.fmt == fmt:
+        if obj_fmt == fmt:
             return sha
 
         if not follow:
             return None
 
+        obj = object_read(repo, sha)
+
         # Follow tags
         if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode("ascii")
+            sha = obj.header_one(b'object').decode("ascii")
         elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode("ascii")
+            sha = obj.tree
         else:
             return None
 
+# rev:path
+# 只需要沿着路径一层一层往下读树，每一层在排好序的条目中二分查找（GitTree.find），不用遍历整个树。
+
+def tree_lookup(repo, sha, path):
+    """返回树sha中path指向的对象，path为空时就是这个树本身"""
+    names = [ name for name in path.split("/") if name ]
+    for i, name in enumerate(names):
+        # 先只看类型，路径经过一个很大的blob时不用解压它
+        if object_header(repo, sha)[0] != b'tree':
+            raise Exception("{}不是目录".format("/".join(names[:i])))
+        tree = object_read(repo, sha)
+        leaf = tree.find(name.encode())
+        if leaf is None:
+            raise Exception("路径{}不存在".format(path))
+        sha = leaf.sha
+    return sha
+
 
 argsp = argsubparsers.add_parser(
     "rev-parse",
@@ -838,17 +2364,629 @@ argsp.add_argument("--wyag-type",
                    default=None,
                    help="Specify the expected type")
 
+argsp.add_argument("--short",
+                   action="store_true",
+                   help="输出最短的唯一缩写（至少core.abbrev个字符，默认7）")
+
 argsp.add_argument("name",
                    help="The name to parse")
 
 
 def cmd_rev_parse(args):
+    fmt = None
     if args.type:
         fmt = args.type.encode()
 
     repo = repo_find()
 
-    print (object_find(repo, args.name, args.type, follow=True))
+    sha = object_find(repo, args.name, fmt, follow=True)
+    if sha and args.short:
+        sha = object_abbrev(repo, sha, int(repo.conf.get("core", "abbrev", fallback="7")))
+    print (sha)
+
+
+# git repack / git gc
+# object_writer 只会写松散对象，对象目录会无限增长。
+# repack 从所有的ref出发找出可达对象，选择delta基对象后写成一个 .pack 和 .idx，然后删除已经打包的松散对象。
+#
+# 选择delta基对象的方法和git一样: 先按 (类型, 路径名hash, 大小从大到小) 排序，
+# 这样同一个文件的不同版本会排在一起，然后每个对象只和前面窗口(window)里同类型的对象尝试做delta。
+
+def object_reachable(repo):
+    """从HEAD和所有ref出发遍历，返回可达对象 [(sha, 路径名)]，路径名用来给delta排序"""
+    roots = list()
+    if os.path.exists(repo_file(repo, "HEAD")):
+        try:
+            roots.append(ref_resolve(repo, "HEAD"))
+        except FileNotFoundError:
+            # HEAD指向的分支还没有提交
+            pass
+
+    stack = [ref_list(repo)]
+    while stack:
+        for v in stack.pop().values():
+            if type(v) == str:
+                roots.append(v)
+            else:
+                stack.append(v)
+
+    ret = list()
+    seen = set()
+    # 栈中是 (sha, 路径名, 类型)，类型不知道时为None
+    stack = [ (sha, b'', None) for sha in reversed(roots) ]
+    while stack:
+        sha, name, fmt = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        ret.append((sha, name))
+
+        # blob没有指向别的对象，不用读取（可能很大）
+        if fmt is None:
+            fmt, size = object_header(repo, sha)
+        if fmt == b'blob':
+            continue
+
+        fmt, data = object_read_raw(repo, sha)
+        if fmt == b'commit':
+            commit = GitCommit(repo, data)
+            for p in reversed(commit.parents):
+                stack.append((p, b'', b'commit'))
+            stack.append((commit.tree, b'', b'tree'))
+        elif fmt == b'tag':
+            tag = GitTag(repo, data)
+            stack.append((tag.header_one(b'object').decode("ascii"), b'', None))
+        elif fmt == b'tree':
+            for item in reversed(tree_parse(data)):
+                # 子模块(gitlink)指向的是别的仓库的commit
+                if item.mode == b'160000':
+                    continue
+                # 树的条目从mode就能知道类型
+                stack.append((item.sha, item.path, b'tree' if item.mode.startswith(b'4') else b'blob'))
+
+    return ret
+
+def pack_name_hash(name):
+    """git的路径名hash: 主要由最后16个非空白字符决定，同名的文件会排到一起"""
+    h = 0
+    for c in name:
+        if c in b' \t\n\r':
+            continue
+        h = ((h >> 2) + (c << 24)) & 0xffffffff
+    return h
+
+def pack_entry_encode(typ, size):
+    """pack_entry_header的逆操作"""
+    c = (typ << 4) | (size & 0x0f)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return ret
+
+def pack_ofs_encode(ofs):
+    ret = [ofs & 0x7f]
+    ofs >>= 7
+    while ofs:
+        ofs -= 1
+        ret.append((ofs & 0x7f) | 0x80)
+        ofs >>= 7
+    return bytes(reversed(ret))
+
+pack_fmt_type = { v: k for k, v in pack_type_fmt.items() }
+
+def pack_write(repo, objects, window=10, depth=50):
+    """把objects [(sha, 路径名)] 写成一个新的pack和idx，返回pack的名字（pack-xxx）
+    第一遍只读对象头得到类型和大小用来排序，第二遍写入时才读取内容，窗口里只保留最近window个对象的内容"""
+    entries = list()
+    for sha, name in objects:
+        fmt, size = object_header(repo, sha)
+        entries.append((pack_fmt_type[fmt], pack_name_hash(name), size, sha))
+    entries.sort(key=lambda e: (e[0], e[1], -e[2]))
+
+    path = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp = os.path.join(path, "tmp_pack_{}".format(os.getpid()))
+
+    offsets = dict()
+    crcs = dict()
+    depths = dict()
+    win = collections.deque(maxlen=window)
+    checksum = hashlib.sha1()
+
+    with open(tmp, "wb") as f:
+        def write(b):
+            checksum.update(b)
+            f.write(b)
+
+        write(b'PACK' + struct.pack(">II", 2, len(entries)))
+        offset = 12
+
+        for typ, namehash, size, sha in entries:
+            fmt, data = object_read_raw(repo, sha)
+            level = compression_level(repo, fmt, data[:ENTROPY_SAMPLE], loose=False)
+
+            # 在窗口中找一个生成delta最小的基对象
+            best = None
+            if window and size >= 64:
+                for w in win:
+                    btyp, bsha, bdata, bindex = w
+                    if btyp != typ or depths[bsha] >= depth:
+                        continue
+                    if len(bdata) < size // 32:
+                        # 大小差得太多不值得尝试
+                        continue
+                    if bindex is None:
+                        # 基对象的索引在第一次用到时建立，之后留在窗口里重复使用
+                        bindex = w[3] = delta_index(bdata)
+                    # delta至少要比对象小一半，而且要比已经找到的更小，否则中途就放弃
+                    limit = size // 2 if best is None else len(best[1]) - 1
+                    delta = delta_create(bdata, data, max_size=limit, index=bindex)
+                    if delta is not None:
+                        best = (bsha, delta)
+
+            if best:
+                bsha, delta = best
+                entry = pack_entry_encode(PACK_OBJ_OFS_DELTA, len(delta)) + pack_ofs_encode(offset - offsets[bsha]) + zlib.compress(delta, level)
+                depths[sha] = depths[bsha] + 1
+            else:
+                entry = pack_entry_encode(typ, size) + zlib.compress(data, level)
+                depths[sha] = 0
+
+            offsets[sha] = offset
+            crcs[sha] = zlib.crc32(entry)
+            write(entry)
+            offset += len(entry)
+            win.append([typ, sha, data, None])
+
+        packsum = checksum.digest()
+        f.write(packsum)
+
+    name = "pack-" + packsum.hex()
+    idx = pack_index_build(offsets, crcs, packsum)
+
+    with open(tmp + ".idx", "wb") as f:
+        f.write(idx)
+    # 先放好pack再放idx，idx出现时pack一定是完整的
+    os.replace(tmp, os.path.join(path, name + ".pack"))
+    os.replace(tmp + ".idx", os.path.join(path, name + ".idx"))
+
+    repo.packs = None
+    return name
+
+def pack_index_build(offsets, crcs, packsum):
+    """生成version 2的idx文件内容"""
+    shas = sorted(offsets.keys())
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    small = list()
+    large = list()
+    for sha in shas:
+        ofs = offsets[sha]
+        if ofs < 0x80000000:
+            small.append(ofs)
+        else:
+            small.append(0x80000000 | len(large))
+            large.append(ofs)
+
+    ret = [ b'\377tOc', struct.pack(">I", 2), struct.pack(">256I", *fanout) ]
+    ret.append(b''.join(bytes.fromhex(sha) for sha in shas))
+    ret.append(b''.join(struct.pack(">I", crcs[sha]) for sha in shas))
+    ret.append(struct.pack(">{}I".format(len(small)), *small))
+    ret.append(struct.pack(">{}Q".format(len(large)), *large))
+    ret.append(packsum)
+    ret = b''.join(ret)
+    return ret + hashlib.sha1(ret).digest()
+
+def repack(repo, window=None, depth=None):
+    """把所有可达对象写进一个新的pack，然后删除被它包含的松散对象和旧pack
+    window和depth默认从配置pack.window（10）和pack.depth（50）中读取"""
+    if window is None:
+        window = int(repo.conf.get("pack", "window", fallback="10"))
+    if depth is None:
+        depth = int(repo.conf.get("pack", "depth", fallback="50"))
+
+    # 可以从alternates读到的对象不打包（和git repack -l一样），否则就失去了共享的意义
+    objects = [ o for o in object_reachable(repo) if not object_borrowed(repo, o[0]) ]
+    if not objects:
+        return None
+
+    old = [ pack for pack in pack_all(repo) if pack.local ]
+    name = pack_write(repo, objects, window, depth)
+
+    packed = set(sha for sha, _ in objects)
+
+    # 删除已经打包的松散对象
+    for sha in packed:
+        path = repo_file(repo, "objects", sha[:2], sha[2:])
+        if path and os.path.isfile(path):
+            os.remove(path)
+            loose_index(repo)[0].discard(sha)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                # 目录里还有别的对象
+                pass
+
+    # 删除所有对象都已经在新pack中的旧pack
+    for pack in old:
+        if pack.packpath.endswith(name + ".pack"):
+            continue
+        if all(sha in packed for sha in pack.shas()):
+            pack.close()
+            os.remove(pack.idxpath)
+            os.remove(pack.packpath)
+
+    repo.packs = None
+    repo.object_ids = None
+
+    # 已经有multi-pack-index的话，按新的pack重写
+    if os.path.isfile(repo_file(repo, "objects", "pack", "multi-pack-index")):
+        midx_write(repo)
+
+    return name
+
+argsp = argsubparsers.add_parser("repack", help="把可达对象打包成一个packfile")
+
+argsp.add_argument("--window",
+                   type=int,
+                   default=None,
+                   help="寻找delta基对象的窗口大小（默认是配置pack.window）")
+
+argsp.add_argument("--depth",
+                   type=int,
+                   default=None,
+                   help="delta链的最大深度（默认是配置pack.depth）")
+
+def cmd_repack(args):
+    repo = repo_find()
+    name = repack(repo, args.window, args.depth)
+    if name:
+        print(name)
+
+argsp = argsubparsers.add_parser("gc", help="清理并打包仓库中的对象")
+
+argsp.add_argument("--aggressive",
+                   action="store_true",
+                   help="用更大的窗口寻找delta，更慢但是pack更小")
+
+def cmd_gc(args):
+    repo = repo_find()
+    if args.aggressive:
+        repack(repo,
+               window=int(repo.conf.get("gc", "aggressivewindow", fallback="250")),
+               depth=int(repo.conf.get("gc", "aggressivedepth", fallback="50")))
+    else:
+        repack(repo)
+
+
+# git clone（本地仓库）
+# 用repo_create创建新仓库，复制对象、ref和HEAD，然后检出HEAD。
+# 对象文件写入以后就不会再修改（重写也是rename一个新文件过去），所以可以直接硬链接，在同一个文件系统上几乎不花时间；
+# 硬链接失败（跨文件系统）时试试reflink（写时复制，btrfs/xfs），最后才真正复制数据。
+# --shared 不复制任何对象，而是在 objects/info/alternates 中指向源仓库的对象目录，几乎不花时间，
+# 代价是源仓库的对象不能被删除（不要在源仓库里删除不可达对象）。
+
+argsp = argsubparsers.add_parser("clone", help="克隆一个本地仓库")
+
+argsp.add_argument("--shared",
+                   action="store_true",
+                   help="不复制对象，通过objects/info/alternates借用源仓库的对象")
+
+argsp.add_argument("--no-hardlinks",
+                   dest="hardlinks",
+                   action="store_false",
+                   help="不用硬链接，复制对象文件")
+
+argsp.add_argument("repository",
+                   help="源仓库的路径")
+
+argsp.add_argument("directory",
+                   nargs="?",
+                   help="新仓库的路径（默认是源仓库的目录名）")
+
+def cmd_clone(args):
+    src = GitRepository(os.path.realpath(args.repository))
+    path = args.directory or os.path.basename(os.path.realpath(args.repository))
+    repo_clone(src, path, shared=args.shared, hardlinks=args.hardlinks)
+
+def repo_clone(src, path, shared=False, hardlinks=True):
+    """把本地仓库src克隆到path，返回新的GitRepository"""
+    repo = repo_create(path)
+
+    if shared:
+        with open(repo_file(repo, "objects", "info", "alternates", mkdir=True), "w") as f:
+            f.write(object_dirs(src)[0] + "\n")
+    else:
+        clone_objects(src, repo, hardlinks)
+
+    # ref 和 HEAD
+    clone_refs(repo, ref_list(src), "refs")
+    with open(repo_file(src, "HEAD"), "r") as f:
+        head = f.read()
+    with open(repo_file(repo, "HEAD"), "w") as f:
+        f.write(head)
+
+    # 检出HEAD（还没有提交的空仓库就不用检出了）
+    try:
+        sha = ref_resolve(repo, "HEAD")
+    except FileNotFoundError:
+        return repo
+    commit = object_read(repo, sha)
+    tree = object_read(repo, commit.tree)
+    tree_checkout(repo, tree, os.path.realpath(repo.worktree).encode())
+
+    return repo
+
+def clone_objects(src, repo, hardlinks=True):
+    """把src自己的对象（松散对象、pack、alternates）复制到repo中"""
+    srcdir = object_dirs(src)[0]
+    dstdir = repo_path(repo, "objects")
+
+    for d in sorted(os.listdir(srcdir)):
+        if len(d) != 2 and d != "pack":
+            continue
+
+        for f in os.listdir(os.path.join(srcdir, d)):
+            if f.startswith("tmp_"):
+                continue
+            os.makedirs(os.path.join(dstdir, d), exist_ok=True)
+            file_clone(os.path.join(srcdir, d, f), os.path.join(dstdir, d, f), hardlinks)
+
+    # 源仓库借用的对象，新仓库也要能读到。alternates中的相对路径是相对于源仓库的objects目录的，
+    # 不能直接复制文件，写入object_dirs解析出来的绝对路径
+    borrowed = object_dirs(src)[1:]
+    if borrowed:
+        with open(repo_file(repo, "objects", "info", "alternates", mkdir=True), "w") as f:
+            f.write("".join(path + "\n" for path in borrowed))
+
+FICLONE = 0x40049409 # linux/fs.h 中的 ioctl
+
+def file_clone(src, dst, hardlink=True):
+    """把src放到dst，尽量不复制数据: 硬链接 -> reflink -> 复制"""
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    if fcntl:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                reflinked = True
+            except OSError:
+                reflinked = False
+        if reflinked:
+            shutil.copystat(src, dst)
+            return
+
+    shutil.copy2(src, dst)
+
+def clone_refs(repo, refs, prefix):
+    for k, v in refs.items():
+        if type(v) == str:
+            with open(repo_file(repo, prefix, k, mkdir=True), "w") as f:
+                f.write(v + "\n")
+        else:
+            clone_refs(repo, v, prefix + "/" + k)
+
+
+# multi-pack-index
+# 从上游git导入的仓库经常有很多增量pack，每次查找都要在每个idx里二分查找一次。
+# multi-pack-index把所有pack的对象合并成一个有序表: sha -> (pack编号, 偏移)，不管有多少个pack都只需要一次二分查找。
+# 文件格式和git一样（version 1）:
+# [MIDX] [version 1] [oid version 1] [chunk数] [base文件数 0] [pack数 4字节]
+# chunk表: 每项 [4字节id] [8字节偏移]，最后一项id为0，偏移是最后一个chunk的结尾
+# PNAM: 所有idx文件名，以\0结尾，按名字排序，补齐到4字节
+# OIDF: 256*4字节 fanout     OIDL: N个sha
+# OOFF: N个 [pack编号 4字节] [偏移 4字节]，偏移最高位为1时剩下的位是LOFF的下标
+# LOFF: 8字节的大偏移（可选）
+# 最后是前面所有内容的sha1
+
+class GitMultiPackIndex(object):
+    """objects/pack/multi-pack-index"""
+
+    path = None
+    names = None # idx文件名，按pack编号排列
+    packs = None # 对应的GitPack，第一次查到其中的对象时才创建
+    local = True
+    count = 0 # 对象个数
+
+    def __init__(self, path, windows):
+        self.path = path
+        self.windows = windows
+        self.data = mmap_file(path)
+
+        if self.data[:4] != b'MIDX':
+            raise Exception("{}不是multi-pack-index文件".format(path))
+        vers, oid_vers, nchunks, nbase, npacks = struct.unpack_from(">BBBBI", self.data, 4)
+        if vers != 1 or oid_vers != 1:
+            raise Exception("不支持的multi-pack-index版本号{}".format(vers))
+        if nbase:
+            raise Exception("不支持增量的multi-pack-index")
+
+        self.chunks = dict()
+        for i in range(nchunks):
+            cid, start = struct.unpack_from(">4sQ", self.data, 12 + 12*i)
+            end = struct.unpack_from(">Q", self.data, 12 + 12*(i+1) + 4)[0]
+            self.chunks[cid] = (start, end)
+
+        for cid in (b'PNAM', b'OIDF', b'OIDL', b'OOFF'):
+            if cid not in self.chunks:
+                raise Exception("multi-pack-index缺少{}".format(cid.decode("ascii")))
+
+        start, end = self.chunks[b'PNAM']
+        self.names = bytes(self.data[start:end]).rstrip(b'\x00').decode().split("\x00")[:npacks]
+        self.packs = [None] * len(self.names)
+
+        self.fanout = struct.unpack_from(">256I", self.data, self.chunks[b'OIDF'][0])
+        self.count = self.fanout[255]
+        self.sha_start = self.chunks[b'OIDL'][0]
+        self.ofs_start = self.chunks[b'OOFF'][0]
+        self.large_ofs_start = self.chunks[b'LOFF'][0] if b'LOFF' in self.chunks else None
+
+    def sha(self, i):
+        start = self.sha_start + 20*i
+        return self.data[start:start+20]
+
+    def shas(self):
+        h = self.data[self.sha_start:self.sha_start + 20*self.count].hex()
+        return [ h[i:i+40] for i in range(0, len(h), 40) ]
+
+    def pack(self, pid):
+        """编号为pid的GitPack"""
+        pack = self.packs[pid]
+        if pack is None:
+            pack = GitPack(os.path.join(os.path.dirname(self.path), self.names[pid]), self.windows)
+            pack.local = self.local
+            self.packs[pid] = pack
+        return pack
+
+    def all_packs(self):
+        return [ self.pack(pid) for pid in range(len(self.names)) ]
+
+    def entry(self, i):
+        """第i个对象的 (pack编号, 偏移)"""
+        pid, ofs = struct.unpack_from(">II", self.data, self.ofs_start + 8*i)
+        if ofs & 0x80000000 and self.large_ofs_start is not None:
+            ofs = struct.unpack_from(">Q", self.data, self.large_ofs_start + 8*(ofs & 0x7fffffff))[0]
+        return pid, ofs
+
+    def find(self, sha):
+        """返回 (GitPack, 偏移)，找不到返回None"""
+        i, end = sha_table_bisect(self, int(sha, 16))
+        if i < end and self.sha(i) == bytes.fromhex(sha):
+            pid, ofs = self.entry(i)
+            return self.pack(pid), ofs
+        return None
+
+    def close(self):
+        mmap_close(self.data)
+
+def midx_write(repo):
+    """为objects/pack下所有的pack写multi-pack-index，返回包含的对象个数"""
+    repo.packs = None
+    packs = sorted([ pack for pack in pack_all(repo) if pack.local ], key=lambda pack: os.path.basename(pack.idxpath))
+    midx = pack_midx(repo)
+    if midx:
+        midx.close()
+
+    # 同一个对象在多个pack中时用最新的pack（和git一样）
+    entries = dict()
+    order = sorted(range(len(packs)), key=lambda pid: os.path.getmtime(packs[pid].packpath))
+    for pid in order:
+        pack = packs[pid]
+        for i, sha in enumerate(pack.shas()):
+            entries[sha] = (pid, pack.offset(i))
+    shas = sorted(entries.keys())
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    ooff = list()
+    loff = list()
+    for sha in shas:
+        pid, ofs = entries[sha]
+        if ofs >= 0x80000000:
+            ooff.append(struct.pack(">II", pid, 0x80000000 | len(loff)))
+            loff.append(struct.pack(">Q", ofs))
+        else:
+            ooff.append(struct.pack(">II", pid, ofs))
+
+    pnam = b''.join(os.path.basename(pack.idxpath).encode() + b'\x00' for pack in packs)
+    pnam += b'\x00' * (-len(pnam) % 4)
+
+    chunks = [
+        (b'PNAM', pnam),
+        (b'OIDF', struct.pack(">256I", *fanout)),
+        (b'OIDL', b''.join(bytes.fromhex(sha) for sha in shas)),
+        (b'OOFF', b''.join(ooff)),
+    ]
+    if loff:
+        chunks.append((b'LOFF', b''.join(loff)))
+
+    ret = [ b'MIDX', struct.pack(">BBBBI", 1, 1, len(chunks), 0, len(packs)) ]
+    offset = 12 + 12*(len(chunks)+1)
+    for cid, data in chunks:
+        ret.append(struct.pack(">4sQ", cid, offset))
+        offset += len(data)
+    ret.append(struct.pack(">4sQ", b'\x00'*4, offset))
+    ret += [ data for cid, data in chunks ]
+    ret = b''.join(ret)
+    ret += hashlib.sha1(ret).digest()
+
+    path = repo_file(repo, "objects", "pack", "multi-pack-index", mkdir=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(ret)
+    os.replace(path + ".tmp", path)
+
+    repo.packs = None
+    return len(shas)
+
+def midx_verify(repo):
+    """检查multi-pack-index，返回发现的问题列表（没有问题时为空）"""
+    path = repo_file(repo, "objects", "pack", "multi-pack-index")
+    if not (path and os.path.isfile(path)):
+        return [ "multi-pack-index不存在" ]
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    if hashlib.sha1(raw[:-20]).digest() != raw[-20:]:
+        return [ "multi-pack-index的校验和不对" ]
+
+    repo.packs = None
+    midx = pack_midx(repo)
+    if not midx:
+        return [ "multi-pack-index中的pack不存在" ]
+
+    errors = list()
+    shas = midx.shas()
+    for i in range(1, len(shas)):
+        if shas[i-1] >= shas[i]:
+            errors.append("对象没有排好序: {} {}".format(shas[i-1], shas[i]))
+
+    for i, sha in enumerate(shas):
+        pid, ofs = midx.entry(i)
+        if midx.pack(pid).find(sha) != ofs:
+            errors.append("{}在{}中的偏移不对".format(sha, midx.names[pid]))
+
+    known = set(shas)
+    for pack in midx.all_packs():
+        for sha in pack.shas():
+            if sha not in known:
+                errors.append("{}中的{}不在multi-pack-index中".format(os.path.basename(pack.idxpath), sha))
+
+    return errors
+
+argsp = argsubparsers.add_parser("multi-pack-index", help="写入或检查multi-pack-index")
+
+argsp.add_argument("subcommand",
+                   choices=["write", "verify"],
+                   help="write: 为所有pack写multi-pack-index; verify: 检查它")
+
+def cmd_multi_pack_index(args):
+    repo = repo_find()
+
+    if args.subcommand == "write":
+        midx_write(repo)
+    else:
+        errors = midx_verify(repo)
+        for e in errors:
+            print(e)
+        if errors:
+            raise Exception("multi-pack-index有{}个错误".format(len(errors)))
 
 
 class GitIndexEntry(object):